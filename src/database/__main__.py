@@ -0,0 +1,43 @@
+import asyncio
+from pathlib import Path
+
+import typer
+
+from .crawl_diff import get_crawl_diff
+from .staging import list_database_versions, rollback_database
+
+app = typer.Typer(pretty_exceptions_enable=False)
+
+
+@app.command(help="Список сохранённых версий базы данных, начиная с последней")
+def versions():
+    for version_path in list_database_versions():
+        typer.echo(version_path)
+
+
+@app.command(help="Вернуть предыдущую версию базы данных")
+def rollback(
+    version: Path | None = typer.Option(  # noqa: B008
+        None, "--version", help="Файл версии базы данных, по умолчанию последняя версия"
+    ),
+):
+    version_path = rollback_database(version)
+    typer.echo(f"Восстановлена версия {version_path}")
+
+
+@app.command(help="Изменения задач при последней загрузке")
+def diff(
+    crawl_id: int | None = typer.Option(
+        None, "--crawl-id", help="Номер загрузки, по умолчанию последняя"
+    ),
+):
+    diff_df = asyncio.run(get_crawl_diff(crawl_id))
+    if diff_df.empty:
+        typer.echo("Изменений нет")
+        return
+    typer.echo(diff_df.groupby("change").size().to_string())
+    typer.echo(diff_df.to_string(index=False, max_rows=50))
+
+
+if __name__ == "__main__":
+    app()
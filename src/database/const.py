@@ -1 +1,7 @@
 DATABASE_NAME = "fipibank-problems.db"
+
+# SQLite versions before 3.32 allow at most 999 bound parameters per statement
+SQLITE_MAX_VARIABLE_NUMBER = 999
+
+# Number of rows fetched from a cursor at once by stream_* methods
+DEFAULT_STREAM_CHUNK_SIZE = 1000
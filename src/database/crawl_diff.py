@@ -0,0 +1,257 @@
+"""Differences between consecutive crawls.
+
+Every saved problem is recorded in crawl_seen_* tables with a hash of its condition.
+When a crawl finishes, they are compared with crawl_*_state tables (what the previous
+crawl saw) by set operations over primary key indexes, the differences are written
+to crawl_diff_entries and the seen problems become the new state.
+"""
+
+import hashlib
+
+import pandas as pd
+from sqlalchemy import delete, except_, func, insert, intersect, literal, select, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..problem_types import ProblemData
+from .const import DEFAULT_STREAM_CHUNK_SIZE
+from .models import (
+    Crawl,
+    CrawlChangeEnum,
+    CrawlDiffEntry,
+    CrawlProblemState,
+    CrawlProblemThemeState,
+    CrawlSeenProblem,
+    CrawlSeenProblemTheme,
+    FipiBankProblem,
+    FipiBankProblemCodifierTheme,
+    FipiBankProblemGiaType,
+    FipiBankProblemSubject,
+    GiaType,
+    Subject,
+    Theme,
+    async_session,
+)
+
+
+def get_condition_hash(condition_html: str) -> str:
+    return hashlib.blake2b(condition_html.encode(), digest_size=16).hexdigest()
+
+
+async def record_seen_problems(session: AsyncSession, problems_data: list[ProblemData]) -> None:
+    """Record problems saved by the current crawl in the session transaction"""
+    if not problems_data:
+        return
+    await session.execute(
+        sqlite_insert(CrawlSeenProblem).on_conflict_do_nothing(),
+        [
+            {
+                "problem_id": problem_data.problem_id,
+                "gia_type": problem_data.gia_type,
+                "subject_hash": problem_data.subject_hash,
+                "condition_hash": get_condition_hash(problem_data.condition_html),
+            }
+            for problem_data in problems_data
+        ],
+    )
+    problem_themes = [
+        {"problem_id": problem_data.problem_id, "codifier_id": theme_data.codifier_id}
+        for problem_data in problems_data
+        for theme_data in problem_data.themes
+    ]
+    if problem_themes:
+        await session.execute(
+            sqlite_insert(CrawlSeenProblemTheme).on_conflict_do_nothing(), problem_themes
+        )
+
+
+async def clear_seen_problems() -> None:
+    async with async_session() as session, session.begin():
+        await session.execute(delete(CrawlSeenProblem))
+        await session.execute(delete(CrawlSeenProblemTheme))
+
+
+async def bootstrap_crawl_state(chunk_size: int = DEFAULT_STREAM_CHUNK_SIZE) -> int:
+    """
+    Fills the crawl state from problems in the database if it's empty, so the first
+    crawl with diffs is compared with the problems saved before.
+
+    Returns:
+        Number of problems added to the state
+    """
+    async with async_session() as session:
+        if (await session.execute(select(CrawlProblemState.problem_id).limit(1))).first():
+            return 0
+    # Only hashes of the streamed conditions are kept
+    problem_states = []
+    async with async_session() as session:
+        result = await session.stream(
+            select(
+                FipiBankProblem.problem_id,
+                GiaType.name,
+                Subject.hash,
+                FipiBankProblem.condition_html,
+            )
+            .select_from(
+                FipiBankProblem.__table__.join(FipiBankProblemGiaType)
+                .join(GiaType)
+                .join(FipiBankProblemSubject)
+                .join(Subject)
+            )
+            .execution_options(yield_per=chunk_size)
+        )
+        async for partition in result.partitions():
+            problem_states.extend(
+                {
+                    "problem_id": problem_id,
+                    "gia_type": gia_type,
+                    "subject_hash": subject_hash,
+                    "condition_hash": get_condition_hash(condition_html),
+                }
+                for problem_id, gia_type, subject_hash, condition_html in partition
+            )
+    if not problem_states:
+        return 0
+    async with async_session() as session, session.begin():
+        await session.execute(
+            sqlite_insert(CrawlProblemState).on_conflict_do_nothing(), problem_states
+        )
+        await session.execute(
+            sqlite_insert(CrawlProblemThemeState)
+            .from_select(
+                ["problem_id", "codifier_id"],
+                select(FipiBankProblem.problem_id, Theme.codifier_id).select_from(
+                    FipiBankProblem.__table__.join(FipiBankProblemCodifierTheme).join(Theme)
+                ),
+            )
+            .on_conflict_do_nothing()
+        )
+    return len(problem_states)
+
+
+async def record_crawl_diff(gia_types: list[str]) -> dict[str, int]:
+    """
+    Compares problems seen by the finished crawl with the previous state and makes them
+    the new state of the crawled subjects.
+
+    Only subjects with seen problems are compared, so problems of subjects left out of
+    the crawl aren't reported as removed.
+
+    Returns:
+        Dictionary mapping change names to the number of diff entries
+    """
+    seen_ids = select(CrawlSeenProblem.problem_id)
+    state_ids = select(CrawlProblemState.problem_id)
+    crawled_subjects = select(CrawlSeenProblem.gia_type, CrawlSeenProblem.subject_hash).distinct()
+    crawled_state_ids = state_ids.where(
+        tuple_(CrawlProblemState.gia_type, CrawlProblemState.subject_hash).in_(crawled_subjects)
+    )
+    # Pairs of seen problems that are new or have another condition hash
+    new_conditions = except_(
+        select(CrawlSeenProblem.problem_id, CrawlSeenProblem.condition_hash),
+        select(CrawlProblemState.problem_id, CrawlProblemState.condition_hash),
+    ).subquery()
+    changes = {
+        CrawlChangeEnum.added: except_(seen_ids, state_ids),
+        CrawlChangeEnum.removed: except_(crawled_state_ids, seen_ids),
+        CrawlChangeEnum.changed: intersect(select(new_conditions.c.problem_id), state_ids),
+    }
+    # Theme changes of problems that are both in the state and seen by the crawl
+    common_ids = intersect(seen_ids, state_ids)
+    theme_changes = {
+        CrawlChangeEnum.theme_added: except_(
+            select(CrawlSeenProblemTheme.problem_id, CrawlSeenProblemTheme.codifier_id).where(
+                CrawlSeenProblemTheme.problem_id.in_(common_ids)
+            ),
+            select(CrawlProblemThemeState.problem_id, CrawlProblemThemeState.codifier_id),
+        ),
+        CrawlChangeEnum.theme_removed: except_(
+            select(CrawlProblemThemeState.problem_id, CrawlProblemThemeState.codifier_id).where(
+                CrawlProblemThemeState.problem_id.in_(common_ids)
+            ),
+            select(CrawlSeenProblemTheme.problem_id, CrawlSeenProblemTheme.codifier_id),
+        ),
+    }
+
+    async with async_session() as session, session.begin():
+        crawl = Crawl(gia_types=",".join(gia_types))
+        session.add(crawl)
+        await session.flush()
+        for change, problem_ids in changes.items():
+            problem_ids = problem_ids.subquery()
+            await session.execute(
+                insert(CrawlDiffEntry).from_select(
+                    ["crawl_id", "problem_id", "change"],
+                    select(literal(crawl.id), problem_ids.c[0], literal(change.value)),
+                )
+            )
+        for change, problem_themes in theme_changes.items():
+            problem_themes = problem_themes.subquery()
+            await session.execute(
+                insert(CrawlDiffEntry).from_select(
+                    ["crawl_id", "problem_id", "change", "codifier_id"],
+                    select(
+                        literal(crawl.id),
+                        problem_themes.c[0],
+                        literal(change.value),
+                        problem_themes.c[1],
+                    ),
+                )
+            )
+
+        # Seen problems of the crawled subjects become their state
+        await session.execute(
+            delete(CrawlProblemThemeState).where(
+                CrawlProblemThemeState.problem_id.in_(crawled_state_ids.union(seen_ids))
+            )
+        )
+        await session.execute(
+            delete(CrawlProblemState).where(CrawlProblemState.problem_id.in_(crawled_state_ids))
+        )
+        # A seen problem may still be in the state of another subject
+        await session.execute(
+            insert(CrawlProblemState)
+            .prefix_with("OR REPLACE")
+            .from_select(
+                ["problem_id", "gia_type", "subject_hash", "condition_hash"],
+                select(
+                    CrawlSeenProblem.problem_id,
+                    CrawlSeenProblem.gia_type,
+                    CrawlSeenProblem.subject_hash,
+                    CrawlSeenProblem.condition_hash,
+                ),
+            )
+        )
+        await session.execute(
+            insert(CrawlProblemThemeState).from_select(
+                ["problem_id", "codifier_id"],
+                select(CrawlSeenProblemTheme.problem_id, CrawlSeenProblemTheme.codifier_id),
+            )
+        )
+        await session.execute(delete(CrawlSeenProblem))
+        await session.execute(delete(CrawlSeenProblemTheme))
+
+        changes_count = await session.execute(
+            select(CrawlDiffEntry.change, func.count())
+            .where(CrawlDiffEntry.crawl_id == crawl.id)
+            .group_by(CrawlDiffEntry.change)
+        )
+        return dict(changes_count.fetchall())
+
+
+async def get_crawl_diff(crawl_id: int | None = None) -> pd.DataFrame:
+    """Return diff entries of the crawl, of the last one if crawl_id is None"""
+    async with async_session() as session:
+        if crawl_id is None:
+            crawl_id = (await session.execute(select(func.max(Crawl.id)))).scalar()
+        result = await session.execute(
+            select(
+                CrawlDiffEntry.crawl_id,
+                CrawlDiffEntry.problem_id,
+                CrawlDiffEntry.change,
+                CrawlDiffEntry.codifier_id,
+            )
+            .where(CrawlDiffEntry.crawl_id == crawl_id)
+            .order_by(CrawlDiffEntry.id)
+        )
+        return pd.DataFrame(result.fetchall(), columns=result.keys())
@@ -1,49 +1,94 @@
 import asyncio
+import itertools
+from collections import Counter, defaultdict
+from collections.abc import AsyncIterator, Mapping
 
 import pandas as pd
-from sqlalchemy import select, update
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy import (
+    Case,
+    Row,
+    Select,
+    String,
+    case,
+    cast,
+    delete,
+    distinct,
+    func,
+    insert,
+    inspect,
+    literal,
+    select,
+    update,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from tqdm import tqdm
 
-from ..problem_types import ProblemData
+from ..problem_types import CrawlUnit, ProblemData
+from .const import DEFAULT_STREAM_CHUNK_SIZE, SQLITE_MAX_VARIABLE_NUMBER
+from .crawl_diff import clear_seen_problems, record_seen_problems
 from .models import (
+    Base,
+    CrawlJournalUnit,
+    ExamNumberProposal,
+    FacetCount,
+    FacetEnum,
     FipiBankProblem,
     FipiBankProblemCodifierTheme,
     FipiBankProblemFile,
     FipiBankProblemGiaType,
+    FipiBankProblemNeighbour,
     FipiBankProblemSubject,
     GiaType,
+    ProblemStatusEnum,
     Subject,
     Theme,
     async_session,
 )
 
 
-async def save_subject_problems(problems_data: list[ProblemData]) -> None:
+async def save_subject_problems(
+    problems_data: list[ProblemData], finished_units: list[CrawlUnit] | None = None
+) -> None:
+    """
+    Saves problems and marks crawl units as finished in the same transaction.
+
+    Problems saved earlier get the themes they don't have yet, so problems of one subject
+    can be saved theme by theme.
+    """
     async with async_session() as session, session.begin():
-        # Creating or retrieving theme objects from the database
+        # Creating or retrieving gia type, subject and theme objects from the database
+        gia_type_objects = {}
+        subject_objects = {}
         theme_objects = {}
         for problem_data in tqdm(problems_data, desc="Saving problems to database"):
-            # Creating or retrieving gia_type object from the database
-            gia_type_obj = (
-                await session.execute(
-                    select(GiaType).filter(GiaType.name == problem_data.gia_type)
-                )
-            ).scalar_one_or_none()
+            gia_type_obj = gia_type_objects.get(problem_data.gia_type)
             if gia_type_obj is None:
-                gia_type_obj = GiaType(name=problem_data.gia_type)
-                session.add(gia_type_obj)
+                gia_type_obj = (
+                    await session.execute(
+                        select(GiaType).filter(GiaType.name == problem_data.gia_type)
+                    )
+                ).scalar_one_or_none()
+                if gia_type_obj is None:
+                    gia_type_obj = GiaType(name=problem_data.gia_type)
+                    session.add(gia_type_obj)
+                gia_type_objects[problem_data.gia_type] = gia_type_obj
 
-            # Creating or retrieving subject object from the database
-            subject_obj = await session.execute(
-                select(Subject).filter(Subject.name == problem_data.subject_name)
-            )
-            subject_obj = subject_obj.scalar_one_or_none()
+            subject_obj = subject_objects.get(problem_data.subject_hash)
             if subject_obj is None:
-                subject_obj = Subject(
-                    name=problem_data.subject_name, hash=problem_data.subject_hash
-                )
-                session.add(subject_obj)
+                subject_obj = (
+                    await session.execute(
+                        select(Subject).filter(Subject.name == problem_data.subject_name)
+                    )
+                ).scalar_one_or_none()
+                if subject_obj is None:
+                    subject_obj = Subject(
+                        name=problem_data.subject_name, hash=problem_data.subject_hash
+                    )
+                    session.add(subject_obj)
+                    await session.flush()
+                subject_objects[problem_data.subject_hash] = subject_obj
+
             for theme_data in problem_data.themes:
                 if (theme_data.codifier_id, problem_data.subject_hash) not in theme_objects:
                     theme_obj = await session.execute(
@@ -60,16 +105,19 @@ async def save_subject_problems(problems_data: list[ProblemData]) -> None:
                         )
                         session.add(theme_obj)
                     theme_objects[(theme_data.codifier_id, problem_data.subject_hash)] = theme_obj
-            try:
-                (
-                    await session.execute(
-                        select(FipiBankProblem).filter(
-                            FipiBankProblem.problem_id == problem_data.problem_id
-                        )
+            problem_themes = [
+                theme_objects[(theme_data.codifier_id, problem_data.subject_hash)]
+                for theme_data in problem_data.themes
+            ]
+
+            problem = (
+                await session.execute(
+                    select(FipiBankProblem).filter(
+                        FipiBankProblem.problem_id == problem_data.problem_id
                     )
-                ).scalar_one()
-                continue
-            except NoResultFound:
+                )
+            ).scalar_one_or_none()
+            if problem is None:
                 problem = FipiBankProblem(
                     problem_id=problem_data.problem_id,
                     url=problem_data.url,
@@ -80,25 +128,240 @@ async def save_subject_problems(problems_data: list[ProblemData]) -> None:
                         FipiBankProblemFile(file_url=file_url)
                         for file_url in problem_data.file_urls
                     ],
-                    themes=[
-                        theme_objects[(theme_data.codifier_id, problem_data.subject_hash)]
-                        for theme_data in problem_data.themes
-                    ],
+                    themes=problem_themes,
                 )
                 session.add(problem)
+                continue
+
+            # Problem is already saved, update its condition if it has changed
+            # and link it to the themes it doesn't have yet
+            if problem.condition_html != problem_data.condition_html:
+                problem.condition_html = problem_data.condition_html
+                problem.url = problem_data.url
+            await session.flush()
+            for theme_obj in problem_themes:
+                await session.execute(
+                    sqlite_insert(FipiBankProblemCodifierTheme)
+                    .values(fipibank_problem_id=problem.id, codifier_theme_id=theme_obj.id)
+                    .on_conflict_do_nothing()
+                )
+
+        await record_seen_problems(session, problems_data)
+
+        units_problems_count = Counter(
+            CrawlUnit(problem_data.gia_type, problem_data.subject_hash, theme_data.codifier_id)
+            for problem_data in problems_data
+            for theme_data in problem_data.themes
+        )
+        session.add_all(
+            CrawlJournalUnit(
+                gia_type=unit.gia_type,
+                subject_hash=unit.subject_hash,
+                codifier_id=unit.codifier_id,
+                problems_count=units_problems_count[unit],
+            )
+            for unit in finished_units or []
+        )
 
         await session.commit()
 
 
+async def get_finished_crawl_units(gia_types: list[str]) -> set[CrawlUnit]:
+    async with async_session() as session:
+        result = await session.execute(
+            select(
+                CrawlJournalUnit.gia_type,
+                CrawlJournalUnit.subject_hash,
+                CrawlJournalUnit.codifier_id,
+            ).where(CrawlJournalUnit.gia_type.in_(gia_types))
+        )
+        return {CrawlUnit(*row) for row in result}
+
+
+async def clear_crawl_journal(gia_types: list[str]) -> None:
+    async with async_session() as session, session.begin():
+        await session.execute(
+            delete(CrawlJournalUnit).where(CrawlJournalUnit.gia_type.in_(gia_types))
+        )
+    # Problems seen by the interrupted crawl are seen again by the new one
+    await clear_seen_problems()
+
+
+def _problems_with_details_query(
+    gia_type: str, subject_name: str, content_codifier_theme_ids: list[str]
+) -> Select:
+    return (
+        select(
+            FipiBankProblem.problem_id,
+            FipiBankProblem.url,
+            FipiBankProblem.condition_html,
+            func.group_concat(distinct(Theme.codifier_id)).label("themes"),
+        )
+        .select_from(
+            FipiBankProblem.__table__.join(FipiBankProblemGiaType)
+            .join(GiaType)
+            .join(FipiBankProblemSubject)
+            .join(Subject)
+            .join(FipiBankProblemCodifierTheme)
+            .join(Theme)
+        )
+        .where(
+            GiaType.name == gia_type,
+            Subject.name == subject_name,
+            Theme.codifier_id.in_(content_codifier_theme_ids),
+            FipiBankProblem.exam_number == None,  # noqa: E711
+        )
+        .group_by(FipiBankProblem.id)
+        .order_by(FipiBankProblem.id)
+    )
+
+
+def _subject_problems_query(gia_type: str, subject_name: str) -> Select:
+    return (
+        select(
+            FipiBankProblem.problem_id,
+            FipiBankProblem.url,
+            FipiBankProblem.condition_html,
+        )
+        .select_from(
+            FipiBankProblem.__table__.join(FipiBankProblemGiaType)
+            .join(GiaType)
+            .join(FipiBankProblemSubject)
+            .join(Subject)
+        )
+        .where(
+            GiaType.name == gia_type,
+            Subject.name == subject_name,
+        )
+    )
+
+
+def _problems_by_exam_number_query(exam_number: int | None) -> Select:
+    query = select(
+        FipiBankProblem.problem_id,
+        FipiBankProblem.url,
+        FipiBankProblem.condition_html,
+    )
+    if exam_number is None:
+        return query
+    if exam_number > 0:
+        return query.where(FipiBankProblem.exam_number == exam_number)
+    return query.where(FipiBankProblem.exam_number < 0)
+
+
+def _all_problems_with_details_query() -> Select:
+    return (
+        select(
+            FipiBankProblem.problem_id,
+            GiaType.name.label("gia_type"),
+            Subject.name.label("subject_name"),
+            FipiBankProblem.exam_number,
+            FipiBankProblem.url,
+            FipiBankProblem.condition_html,
+            func.group_concat(distinct(Theme.codifier_id)).label("themes"),
+        )
+        .select_from(
+            FipiBankProblem.__table__.join(FipiBankProblemGiaType)
+            .join(GiaType)
+            .join(FipiBankProblemSubject)
+            .join(Subject)
+            .outerjoin(FipiBankProblemCodifierTheme)
+            .outerjoin(Theme)
+        )
+        .group_by(FipiBankProblem.id, GiaType.name, Subject.name)
+        .order_by(FipiBankProblem.id)
+    )
+
+
+async def _execute_to_df(stmt: Select) -> pd.DataFrame:
+    async with async_session() as session:
+        result = await session.execute(stmt)
+        rows = result.fetchall()
+
+        return pd.DataFrame(rows, columns=result.keys())
+
+
+async def _stream_partitions(
+    stmt: Select, chunk_size: int
+) -> AsyncIterator[tuple[list[str], list[Row]]]:
+    """Yields column names and rows by chunks of chunk_size, fetching them from a cursor lazily"""
+    async with async_session() as session:
+        result = await session.stream(stmt.execution_options(yield_per=chunk_size))
+        columns = list(result.keys())
+        async for partition in result.partitions():
+            yield columns, partition
+
+
+async def _stream_dfs(stmt: Select, chunk_size: int) -> AsyncIterator[pd.DataFrame]:
+    async for columns, partition in _stream_partitions(stmt, chunk_size):
+        yield pd.DataFrame(partition, columns=columns)
+
+
 async def get_problems_with_details(
-    gia_type: str, subject_name: str, content_codifier_theme_id: str
+    gia_type: str, subject_name: str, content_codifier_theme_id: str | list[str]
 ) -> pd.DataFrame:
+    """Return unlabelled problems having any of the given themes.
+
+    Each problem is returned once, its matched themes are joined with commas in "themes" column.
+    """
+    if isinstance(content_codifier_theme_id, str):
+        content_codifier_theme_id = [content_codifier_theme_id]
+    return await _execute_to_df(
+        _problems_with_details_query(gia_type, subject_name, content_codifier_theme_id)
+    )
+
+
+async def stream_problems_with_details(
+    gia_type: str,
+    subject_name: str,
+    content_codifier_theme_id: str | list[str],
+    chunk_size: int = DEFAULT_STREAM_CHUNK_SIZE,
+) -> AsyncIterator[pd.DataFrame]:
+    """Same as get_problems_with_details, but yields DataFrames of at most chunk_size problems"""
+    if isinstance(content_codifier_theme_id, str):
+        content_codifier_theme_id = [content_codifier_theme_id]
+    async for df in _stream_dfs(
+        _problems_with_details_query(gia_type, subject_name, content_codifier_theme_id),
+        chunk_size,
+    ):
+        yield df
+
+
+async def get_subject_problems(gia_type: str, subject_name: str) -> pd.DataFrame:
+    return await _execute_to_df(_subject_problems_query(gia_type, subject_name))
+
+
+async def stream_subject_problems(
+    gia_type: str, subject_name: str, chunk_size: int = DEFAULT_STREAM_CHUNK_SIZE
+) -> AsyncIterator[pd.DataFrame]:
+    """Same as get_subject_problems, but yields DataFrames of at most chunk_size problems"""
+    async for df in _stream_dfs(_subject_problems_query(gia_type, subject_name), chunk_size):
+        yield df
+
+
+async def get_problems_by_exam_number(exam_number: int | None) -> list[Row]:
+    """Return problems with exam given number, return all problems if exam_number is None"""
+    async with async_session() as session:
+        return (await session.execute(_problems_by_exam_number_query(exam_number))).fetchall()
+
+
+async def stream_problems_by_exam_number(
+    exam_number: int | None, chunk_size: int = DEFAULT_STREAM_CHUNK_SIZE
+) -> AsyncIterator[list[Row]]:
+    """Same as get_problems_by_exam_number, but yields lists of at most chunk_size problems"""
+    async for _, partition in _stream_partitions(
+        _problems_by_exam_number_query(exam_number), chunk_size
+    ):
+        yield partition
+
+
+async def get_unlabelled_problems_themes(gia_type: str, subject_name: str) -> pd.DataFrame:
+    """Return ids of problems without exam number and their comma separated themes"""
     async with async_session() as session:
         stmt = (
             select(
                 FipiBankProblem.problem_id,
-                FipiBankProblem.url,
-                FipiBankProblem.condition_html,
+                func.group_concat(distinct(Theme.codifier_id)).label("themes"),
             )
             .select_from(
                 FipiBankProblem.__table__.join(FipiBankProblemGiaType)
@@ -111,10 +374,9 @@ async def get_problems_with_details(
             .where(
                 GiaType.name == gia_type,
                 Subject.name == subject_name,
-                Theme.codifier_id == content_codifier_theme_id,
                 FipiBankProblem.exam_number == None,  # noqa: E711
             )
-            .where(Subject.name == subject_name)
+            .group_by(FipiBankProblem.id)
         )
 
         result = await session.execute(stmt)
@@ -123,73 +385,431 @@ async def get_problems_with_details(
         return pd.DataFrame(rows, columns=result.keys())
 
 
-async def get_subject_problems(gia_type: str, subject_name: str) -> pd.DataFrame:
+async def get_all_problems_with_details() -> pd.DataFrame:
+    """Return all problems with their gia type, subject, exam number and comma separated themes"""
+    return await _execute_to_df(_all_problems_with_details_query())
+
+
+async def get_problems_with_details_by_ids(problem_ids: list[str]) -> pd.DataFrame:
+    """Same as get_all_problems_with_details, but only for the given problems"""
+    problem_ids_chunks = list(
+        itertools.batched(problem_ids, SQLITE_MAX_VARIABLE_NUMBER, strict=False)
+    ) or [()]
+    dfs = [
+        await _execute_to_df(
+            _all_problems_with_details_query().where(
+                FipiBankProblem.problem_id.in_(problem_ids_chunk)
+            )
+        )
+        for problem_ids_chunk in problem_ids_chunks
+    ]
+    return pd.concat(dfs, ignore_index=True)
+
+
+async def stream_all_problems_with_details(
+    chunk_size: int = DEFAULT_STREAM_CHUNK_SIZE,
+) -> AsyncIterator[pd.DataFrame]:
+    """Same as get_all_problems_with_details, but yields DataFrames of at most chunk_size problems"""
+    async for df in _stream_dfs(_all_problems_with_details_query(), chunk_size):
+        yield df
+
+
+async def set_exam_numbers(
+    exam_numbers: Mapping[str, int | None] | pd.DataFrame,
+) -> dict[int | None, int]:
+    """
+    Sets exam numbers of many problems in a single transaction.
+
+    Problems are grouped by their new exam number, and every group is written with
+    set-based "UPDATE ... WHERE problem_id IN (...)" statements, chunked to stay
+    within SQLite bound parameters limit.
+
+    Args:
+        - exam_numbers: Mapping from problem id to exam number or DataFrame
+          with "problem_id" and "exam_number" columns. None (or NaN) removes exam number.
+
+    Returns:
+        Dictionary mapping exam numbers to the number of updated rows
+    """
+    if isinstance(exam_numbers, pd.DataFrame):
+        exam_numbers = dict(
+            zip(exam_numbers["problem_id"], exam_numbers["exam_number"], strict=True)
+        )
+
+    exam_number_problem_ids: defaultdict[int | None, list[str]] = defaultdict(list)
+    for problem_id, exam_number in exam_numbers.items():
+        exam_number = None if pd.isna(exam_number) else int(exam_number)
+        exam_number_problem_ids[exam_number].append(problem_id)
+
+    updated_rows_count: dict[int | None, int] = {}
+    async with async_session() as session, session.begin():
+        for exam_number, problem_ids in exam_number_problem_ids.items():
+            updated_rows_count[exam_number] = 0
+            # One parameter is taken by the exam number itself
+            for problem_ids_chunk in itertools.batched(
+                problem_ids, SQLITE_MAX_VARIABLE_NUMBER - 1, strict=False
+            ):
+                result = await session.execute(
+                    update(FipiBankProblem)
+                    .where(FipiBankProblem.problem_id.in_(problem_ids_chunk))
+                    .values(exam_number=exam_number)
+                    .execution_options(synchronize_session=False)
+                )
+                updated_rows_count[exam_number] += result.rowcount
+        await _refresh_facet_counts(session)
+    return updated_rows_count
+
+
+async def iter_problems_chunks(
+    chunk_size: int, gia_type: str | None = None, subject_name: str | None = None
+) -> AsyncIterator[list[Row]]:
+    """
+    Yields ids and conditions of problems by chunks, optionally of one gia type and subject.
+
+    Every chunk is read with its own short query continuing from the last read id,
+    so nothing stays locked between chunks however long they are processed.
+    """
+    query = select(
+        FipiBankProblem.id,
+        FipiBankProblem.problem_id,
+        FipiBankProblem.condition_html,
+    )
+    if gia_type is not None:
+        query = query.join(FipiBankProblemGiaType).join(GiaType).where(GiaType.name == gia_type)
+    if subject_name is not None:
+        query = (
+            query.join(FipiBankProblemSubject).join(Subject).where(Subject.name == subject_name)
+        )
+    last_id = 0
+    while True:
+        async with async_session() as session:
+            chunk = (
+                await session.execute(
+                    query.where(FipiBankProblem.id > last_id)
+                    .order_by(FipiBankProblem.id)
+                    .limit(chunk_size)
+                )
+            ).fetchall()
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1].id
+
+
+async def get_labelled_problems() -> list[Row]:
+    """Return ids, exam numbers and conditions of all problems with exam number"""
     async with async_session() as session:
-        stmt = (
+        query = (
             select(
                 FipiBankProblem.problem_id,
-                FipiBankProblem.url,
+                FipiBankProblem.exam_number,
                 FipiBankProblem.condition_html,
             )
-            .select_from(
-                FipiBankProblem.__table__.join(FipiBankProblemGiaType)
-                .join(GiaType)
-                .join(FipiBankProblemSubject)
-                .join(Subject)
-            )
-            .where(
-                GiaType.name == gia_type,
-                Subject.name == subject_name,
+            .where(FipiBankProblem.exam_number != None)  # noqa: E711
+            .order_by(FipiBankProblem.id)
+        )
+        return list((await session.execute(query)).fetchall())
+
+
+async def get_problems_file_urls(problem_ids: list[str] | None = None) -> list[Row]:
+    """Return problem ids and urls of their files, of all problems if problem_ids is None"""
+    query = (
+        select(FipiBankProblem.problem_id, FipiBankProblemFile.file_url)
+        .join(FipiBankProblemFile)
+        .order_by(FipiBankProblemFile.id)
+    )
+    async with async_session() as session:
+        if problem_ids is None:
+            return list((await session.execute(query)).fetchall())
+        rows = []
+        for problem_ids_chunk in itertools.batched(
+            problem_ids, SQLITE_MAX_VARIABLE_NUMBER, strict=False
+        ):
+            rows.extend(
+                (
+                    await session.execute(
+                        query.where(FipiBankProblem.problem_id.in_(problem_ids_chunk))
+                    )
+                ).fetchall()
             )
-            .where(Subject.name == subject_name)
+        return rows
+
+
+async def add_exam_number_to_problems(problem_ids: list[str], exam_number: int | None) -> int:
+    updated_rows_count = await set_exam_numbers(dict.fromkeys(problem_ids, exam_number))
+    if not updated_rows_count.get(exam_number):
+        print("No FipiBank problems found with provided IDs.")
+    return updated_rows_count.get(exam_number, 0)
+
+
+async def replace_problem_neighbours(
+    problem_ids: list[str],
+    neighbour_problem_ids: list[list[str]],
+    similarities: list[list[float]],
+) -> int:
+    """Replace all precomputed problem neighbours in one transaction, return inserted rows count"""
+    rows = [
+        {
+            "problem_id": problem_id,
+            "rank": rank,
+            "neighbour_problem_id": neighbour_problem_id,
+            "similarity": similarity,
+        }
+        for problem_id, problem_neighbour_ids, problem_similarities in zip(
+            problem_ids, neighbour_problem_ids, similarities, strict=True
+        )
+        for rank, (neighbour_problem_id, similarity) in enumerate(
+            zip(problem_neighbour_ids, problem_similarities, strict=True)
         )
+    ]
+    async with async_session() as session, session.begin():
+        await session.execute(delete(FipiBankProblemNeighbour))
+        if rows:
+            await session.execute(insert(FipiBankProblemNeighbour), rows)
+    return len(rows)
 
-        result = await session.execute(stmt)
-        rows = result.fetchall()
 
-        return pd.DataFrame(rows, columns=result.keys())
+async def replace_exam_number_proposals(problem_ids: list[str], proposals: pd.DataFrame) -> int:
+    """
+    Replaces exam number proposals of the problems in one transaction.
 
+    Args:
+        - problem_ids: Problems whose previous proposals are removed
+        - proposals: DataFrame with "problem_id", "exam_number" and "confidence" columns
 
-async def get_problems_by_exam_number(exam_number: int | None) -> list[FipiBankProblem]:
-    """Return problems with exam given number, return all problems if exam_number is None"""
-    async with async_session() as session:
-        query = select(
-            FipiBankProblem.problem_id,
+    Returns:
+        Number of inserted proposals
+    """
+    async with async_session() as session, session.begin():
+        for problem_ids_chunk in itertools.batched(
+            problem_ids, SQLITE_MAX_VARIABLE_NUMBER, strict=False
+        ):
+            await session.execute(
+                delete(ExamNumberProposal).where(
+                    ExamNumberProposal.problem_id.in_(problem_ids_chunk)
+                )
+            )
+        rows = proposals[["problem_id", "exam_number", "confidence"]].to_dict("records")
+        if rows:
+            await session.execute(insert(ExamNumberProposal), rows)
+    return len(rows)
+
+
+async def get_exam_number_proposals(min_confidence: float = 0.0) -> pd.DataFrame:
+    """Return proposals of still unlabelled problems with their urls, the most confident first"""
+    return await _execute_to_df(
+        select(
+            ExamNumberProposal.problem_id,
+            ExamNumberProposal.exam_number,
+            ExamNumberProposal.confidence,
             FipiBankProblem.url,
-            FipiBankProblem.condition_html,
         )
-        if exam_number is None:
-            return (await session.execute(query)).fetchall()
-        if exam_number > 0:
-            query = query.where(FipiBankProblem.exam_number == exam_number)
-        else:
-            query = query.where(FipiBankProblem.exam_number < 0)
-        return (await session.execute(query)).fetchall()
+        .join(FipiBankProblem, FipiBankProblem.problem_id == ExamNumberProposal.problem_id)
+        .where(
+            FipiBankProblem.exam_number.is_(None),
+            ExamNumberProposal.confidence >= min_confidence,
+        )
+        .order_by(ExamNumberProposal.confidence.desc())
+    )
 
 
-async def add_exam_number_to_problems(problem_ids: list[str], exam_number: int | None) -> None:
-    async with async_session() as session:
-        try:
-            problems = await session.execute(
-                select(FipiBankProblem).filter(FipiBankProblem.problem_id.in_(problem_ids))
+async def accept_exam_number_proposals(min_confidence: float) -> int:
+    """
+    Sets proposed exam numbers of still unlabelled problems with one UPDATE ... FROM statement
+    and removes the accepted proposals.
+
+    Returns:
+        Number of labelled problems
+    """
+    is_accepted = ExamNumberProposal.confidence >= min_confidence
+    async with async_session() as session, session.begin():
+        await _create_missing_tables(session, ExamNumberProposal)
+        labelled_problems_count = (
+            await session.execute(
+                update(FipiBankProblem)
+                .where(
+                    FipiBankProblem.problem_id == ExamNumberProposal.problem_id,
+                    FipiBankProblem.exam_number.is_(None),
+                    is_accepted,
+                )
+                .values(exam_number=ExamNumberProposal.exam_number)
+                .execution_options(synchronize_session=False)
             )
-            problems = problems.scalars().all()
+        ).rowcount
+        await session.execute(delete(ExamNumberProposal).where(is_accepted))
+        await _refresh_facet_counts(session)
+    return labelled_problems_count
 
-            for problem in problems:
-                problem.exam_number = exam_number
 
-            await session.commit()
-        except NoResultFound:
-            print("No FipiBank problems found with provided IDs.")
+async def get_similar_problems(problem_id: str, limit: int | None = None) -> list[Row]:
+    """Return precomputed most similar problems, ordered from the most similar one"""
+    async with async_session() as session:
+        query = (
+            select(
+                FipiBankProblemNeighbour.neighbour_problem_id.label("problem_id"),
+                FipiBankProblem.url,
+                FipiBankProblemNeighbour.similarity,
+            )
+            .join(
+                FipiBankProblem,
+                FipiBankProblem.problem_id == FipiBankProblemNeighbour.neighbour_problem_id,
+            )
+            .where(FipiBankProblemNeighbour.problem_id == problem_id)
+            .order_by(FipiBankProblemNeighbour.rank)
+            .limit(limit)
+        )
+        return list((await session.execute(query)).fetchall())
 
 
 async def delete_exam_numbers():
     async with async_session() as session:
         stmt = update(FipiBankProblem).values({FipiBankProblem.exam_number: None})
         await session.execute(stmt)
+        await _refresh_facet_counts(session)
         await session.commit()
 
 
+def _problem_status_expression() -> Case:
+    return case(
+        (FipiBankProblem.exam_number > 0, ProblemStatusEnum.actual.value),
+        (FipiBankProblem.exam_number < 0, ProblemStatusEnum.outdated.value),
+        else_=ProblemStatusEnum.unlabelled.value,
+    )
+
+
+def _facet_counts_query(facet: FacetEnum) -> Select:
+    if facet == FacetEnum.theme:
+        value = Theme.codifier_id
+    elif facet == FacetEnum.exam_number:
+        value = cast(FipiBankProblem.exam_number, String)
+    else:
+        value = _problem_status_expression()
+    query = select(
+        GiaType.name,
+        Subject.name,
+        literal(facet.value),
+        value,
+        func.count(distinct(FipiBankProblem.id)),
+    ).select_from(
+        FipiBankProblem.__table__.join(FipiBankProblemGiaType)
+        .join(GiaType)
+        .join(FipiBankProblemSubject)
+        .join(Subject)
+    )
+    if facet == FacetEnum.theme:
+        query = query.join(FipiBankProblemCodifierTheme).join(Theme)
+    elif facet == FacetEnum.exam_number:
+        query = query.where(FipiBankProblem.exam_number > 0)
+    return query.group_by(GiaType.name, Subject.name, value)
+
+
+async def _create_missing_tables(session: AsyncSession, *models: type[Base]) -> bool:
+    """Create tables of the models in databases made before them, return whether any was"""
+    connection = await session.connection()
+    missing_tables = await connection.run_sync(
+        lambda conn: [
+            model.__table__ for model in models if not inspect(conn).has_table(model.__tablename__)
+        ]
+    )
+    if missing_tables:
+        await connection.run_sync(Base.metadata.create_all, tables=missing_tables)
+    return bool(missing_tables)
+
+
+async def _refresh_facet_counts(session: AsyncSession) -> None:
+    await _create_missing_tables(session, FacetCount)
+    await session.execute(delete(FacetCount))
+    for facet in FacetEnum:
+        await session.execute(
+            insert(FacetCount).from_select(
+                ["gia_type", "subject_name", "facet", "value", "problems_count"],
+                _facet_counts_query(facet),
+            )
+        )
+
+
+async def refresh_facet_counts() -> None:
+    """Recount problems by facet values, should be called after problems or labels change"""
+    async with async_session() as session, session.begin():
+        await _refresh_facet_counts(session)
+
+
+async def get_facet_counts(
+    gia_type: str | None = None, subject_name: str | None = None
+) -> list[Row]:
+    """Return precomputed numbers of problems by subject, facet and facet value"""
+    query = select(
+        FacetCount.gia_type,
+        FacetCount.subject_name,
+        FacetCount.facet,
+        FacetCount.value,
+        FacetCount.problems_count,
+    ).order_by(FacetCount.gia_type, FacetCount.subject_name, FacetCount.facet)
+    if gia_type is not None:
+        query = query.where(FacetCount.gia_type == gia_type)
+    if subject_name is not None:
+        query = query.where(FacetCount.subject_name == subject_name)
+    async with async_session() as session, session.begin():
+        if await _create_missing_tables(session, FacetCount):
+            await _refresh_facet_counts(session)
+        return list((await session.execute(query)).fetchall())
+
+
+async def get_filtered_problems(
+    gia_type: str | None = None,
+    subject_name: str | None = None,
+    codifier_id: str | None = None,
+    exam_number: int | None = None,
+    status: ProblemStatusEnum | None = None,
+    limit: int | None = None,
+    offset: int = 0,
+) -> list[Row]:
+    """
+    Return problems matching all given filters, ordered by their database id.
+
+    Args:
+        - gia_type: Gia type name ("oge" or "ege")
+        - subject_name: Subject name
+        - codifier_id: Codifier id of a problem theme, e.g. "2.1"
+        - exam_number: Exact exam number
+        - status: Actual, outdated or unlabelled problems
+        - limit: Maximum number of returned problems, all if None
+        - offset: Number of matching problems to skip
+
+    Returns:
+        Rows with problem_id, exam_number, url and condition_html
+    """
+    query = select(
+        FipiBankProblem.problem_id,
+        FipiBankProblem.exam_number,
+        FipiBankProblem.url,
+        FipiBankProblem.condition_html,
+    )
+    if gia_type is not None:
+        query = query.join(FipiBankProblemGiaType).join(GiaType).where(GiaType.name == gia_type)
+    if subject_name is not None:
+        query = (
+            query.join(FipiBankProblemSubject).join(Subject).where(Subject.name == subject_name)
+        )
+    if codifier_id is not None:
+        query = (
+            query.join(FipiBankProblemCodifierTheme)
+            .join(Theme)
+            .where(Theme.codifier_id == codifier_id)
+        )
+    if exam_number is not None:
+        query = query.where(FipiBankProblem.exam_number == exam_number)
+    if status == ProblemStatusEnum.actual:
+        query = query.where(FipiBankProblem.exam_number > 0)
+    elif status == ProblemStatusEnum.outdated:
+        query = query.where(FipiBankProblem.exam_number < 0)
+    elif status == ProblemStatusEnum.unlabelled:
+        query = query.where(FipiBankProblem.exam_number == None)  # noqa: E711
+    query = query.order_by(FipiBankProblem.id).limit(limit).offset(offset)
+    async with async_session() as session:
+        return list((await session.execute(query)).fetchall())
+
+
 if __name__ == "__main__":
     # df = asyncio.run(get_subject_problems(gia_type="ege", subject_name="Информатика и ИКТ"))
     # print(len(df))
@@ -1,6 +1,19 @@
 from enum import Enum
-
-from sqlalchemy import Column, ForeignKey, Integer, String, UniqueConstraint, delete
+from pathlib import Path
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    UniqueConstraint,
+    func,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Connection
 from sqlalchemy.ext.asyncio import (
     AsyncAttrs,
     AsyncEngine,
@@ -19,6 +32,26 @@ class GiaTypeEnum(Enum):
     ege = "ege"
 
 
+class ProblemStatusEnum(Enum):
+    actual = "actual"  # positive exam number
+    outdated = "outdated"  # negative exam number
+    unlabelled = "unlabelled"  # no exam number
+
+
+class FacetEnum(Enum):
+    theme = "theme"
+    exam_number = "exam_number"
+    status = "status"
+
+
+class CrawlChangeEnum(Enum):
+    added = "added"
+    removed = "removed"
+    changed = "changed"  # condition html differs
+    theme_added = "theme_added"
+    theme_removed = "theme_removed"
+
+
 class Base(AsyncAttrs, DeclarativeBase):
     pass
 
@@ -31,9 +64,11 @@ class GiaType(Base):
 
     @classmethod
     async def insert_data(cls, session: AsyncSession) -> None:
-        await session.execute(delete(cls))
-        session.add_all(
-            [cls(id=0, name=GiaTypeEnum.oge.value), cls(id=1, name=GiaTypeEnum.ege.value)]
+        # Rows are never rewritten, so registering models doesn't lock a database in use
+        await session.execute(
+            sqlite_insert(cls)
+            .values([(0, GiaTypeEnum.oge.value), (1, GiaTypeEnum.ege.value)])
+            .on_conflict_do_nothing()
         )
         await session.commit()
 
@@ -54,6 +89,10 @@ class Theme(Base):
     codifier_id = Column(String, nullable=False)
     name = Column(String, nullable=False)
 
+    __table_args__ = (
+        Index("ix_codifier_themes_subject_id_codifier_id", "subject_id", "codifier_id"),
+    )
+
 
 class FipiBankProblem(Base):
     __tablename__ = "fipibank_problems"
@@ -68,7 +107,7 @@ class FipiBankProblem(Base):
     subject = relationship("Subject", secondary="fipibank_problems_subjects")
     file_urls = relationship("FipiBankProblemFile")
     themes = relationship("Theme", secondary="fipibank_problems_codifier_themes")
-    exam_number = Column(Integer, nullable=True)
+    exam_number = Column(Integer, nullable=True, index=True)
 
     def __repr__(self) -> str:
         return f"<FipiBankProblem problem_id={self.problem_id}>"
@@ -80,6 +119,11 @@ class FipiBankProblemGiaType(Base):
     fipibank_problem_id = Column(Integer, ForeignKey("fipibank_problems.id"), primary_key=True)
     gia_type_id = Column(Integer, ForeignKey("gia_types.id"), primary_key=True)
 
+    # Primary key index serves lookups by problem, this one serves filtering by gia type
+    __table_args__ = (
+        Index("ix_fipibank_problems_gia_types_gia_type_id", "gia_type_id", "fipibank_problem_id"),
+    )
+
 
 class FipiBankProblemSubject(Base):
     __tablename__ = "fipibank_problems_subjects"
@@ -87,12 +131,16 @@ class FipiBankProblemSubject(Base):
     fipibank_problem_id = Column(Integer, ForeignKey("fipibank_problems.id"), primary_key=True)
     subject_id = Column(Integer, ForeignKey("subjects.id"), primary_key=True)
 
+    __table_args__ = (
+        Index("ix_fipibank_problems_subjects_subject_id", "subject_id", "fipibank_problem_id"),
+    )
+
 
 class FipiBankProblemFile(Base):
     __tablename__ = "fipibank_problem_files"
 
     id = Column(Integer, primary_key=True)
-    fipibank_problem_id = Column(Integer, ForeignKey("fipibank_problems.id"))
+    fipibank_problem_id = Column(Integer, ForeignKey("fipibank_problems.id"), index=True)
     file_url = Column(String, nullable=False)
 
 
@@ -107,18 +155,156 @@ class FipiBankProblemCodifierTheme(Base):
             "codifier_theme_id",
             name="unique_fipibank_problem_codifier_theme",
         ),
+        Index(
+            "ix_fipibank_problems_codifier_themes_codifier_theme_id",
+            "codifier_theme_id",
+            "fipibank_problem_id",
+        ),
+    )
+
+
+class FipiBankProblemNeighbour(Base):
+    """One of the most similar problems to a problem, precomputed by a batch job"""
+
+    __tablename__ = "fipibank_problem_neighbours"
+
+    problem_id = Column(String(6), primary_key=True)
+    rank = Column(Integer, primary_key=True)  # 0 for the most similar problem
+    neighbour_problem_id = Column(String(6), nullable=False)
+    similarity = Column(Float, nullable=False)
+
+
+class ExamNumberProposal(Base):
+    """Exam number proposed for an unlabelled problem by label propagation"""
+
+    __tablename__ = "exam_number_proposals"
+
+    problem_id = Column(String(6), primary_key=True)
+    exam_number = Column(Integer, nullable=False)  # negative for outdated problems
+    confidence = Column(Float, nullable=False, index=True)
+
+
+class FacetCount(Base):
+    """Number of problems of a subject with a facet value, e.g. having a theme or an exam number.
+
+    Precomputed by refresh_facet_counts after crawls and labelling, so filters are filled
+    without counting problems on every request.
+    """
+
+    __tablename__ = "facet_counts"
+
+    gia_type = Column(String(3), primary_key=True)
+    subject_name = Column(String, primary_key=True)
+    facet = Column(String, primary_key=True)  # one of FacetEnum values
+    value = Column(String, primary_key=True)
+    problems_count = Column(Integer, nullable=False)
+
+
+class CrawlJournalUnit(Base):
+    """Theme of a subject whose problems are already saved by the current crawl"""
+
+    __tablename__ = "crawl_journal"
+
+    id = Column(Integer, primary_key=True)
+    gia_type = Column(String(3), nullable=False)
+    subject_hash = Column(String, nullable=False)
+    codifier_id = Column(String, nullable=False)
+    problems_count = Column(Integer, nullable=False)
+    finished_at = Column(DateTime, nullable=False, server_default=func.now())
+
+    __table_args__ = (
+        UniqueConstraint(
+            "gia_type", "subject_hash", "codifier_id", name="unique_crawl_journal_unit"
+        ),
     )
 
 
+class Crawl(Base):
+    """Finished crawl, its differences from the previous state are crawl_diff_entries"""
+
+    __tablename__ = "crawls"
+
+    id = Column(Integer, primary_key=True)
+    gia_types = Column(String, nullable=False)  # comma separated
+    finished_at = Column(DateTime, nullable=False, server_default=func.now())
+
+
+class CrawlDiffEntry(Base):
+    __tablename__ = "crawl_diff_entries"
+
+    id = Column(Integer, primary_key=True)
+    crawl_id = Column(Integer, ForeignKey("crawls.id"), nullable=False, index=True)
+    problem_id = Column(String(6), nullable=False)
+    change = Column(String, nullable=False)  # one of CrawlChangeEnum values
+    codifier_id = Column(String, nullable=True)  # for theme changes only
+
+
+class CrawlProblemState(Base):
+    """Problem as it was seen by the last finished crawl"""
+
+    __tablename__ = "crawl_problem_states"
+
+    problem_id = Column(String(6), primary_key=True)
+    gia_type = Column(String(3), nullable=False)
+    subject_hash = Column(String, nullable=False)
+    condition_hash = Column(String, nullable=False)
+
+
+class CrawlProblemThemeState(Base):
+    __tablename__ = "crawl_problem_theme_states"
+
+    problem_id = Column(String(6), primary_key=True)
+    codifier_id = Column(String, primary_key=True)
+
+
+class CrawlSeenProblem(Base):
+    """Problem as it is seen by the current crawl, compared with its state when it finishes"""
+
+    __tablename__ = "crawl_seen_problems"
+
+    problem_id = Column(String(6), primary_key=True)
+    gia_type = Column(String(3), nullable=False)
+    subject_hash = Column(String, nullable=False)
+    condition_hash = Column(String, nullable=False)
+
+
+class CrawlSeenProblemTheme(Base):
+    __tablename__ = "crawl_seen_problem_themes"
+
+    problem_id = Column(String(6), primary_key=True)
+    codifier_id = Column(String, primary_key=True)
+
+
+def _create_missing_indexes(conn: Connection) -> None:
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
 async def register_models() -> None:
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        # create_all adds indexes only with new tables, so indexes added to
+        # existing tables are created separately
+        await conn.run_sync(_create_missing_indexes)
 
     async with async_session() as session:
         await GiaType.insert_data(session)
 
 
-engine: AsyncEngine = create_async_engine(
-    url=f"sqlite+aiosqlite:///{PathControl.get(f'../{DATABASE_NAME}')}"
-)
+def _create_engine(path: Path) -> AsyncEngine:
+    return create_async_engine(url=f"sqlite+aiosqlite:///{path}")
+
+
+async def set_database_path(path: Path) -> None:
+    """Make engine and async_session work with another database file, e.g. a staging one"""
+    global engine
+    await engine.dispose()
+    engine = _create_engine(path)
+    async_session.configure(bind=engine)
+
+
+DATABASE_PATH = PathControl.get(f"../{DATABASE_NAME}")
+
+engine: AsyncEngine = _create_engine(DATABASE_PATH)
 async_session = async_sessionmaker(bind=engine, expire_on_commit=False)
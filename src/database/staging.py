@@ -0,0 +1,304 @@
+"""Building a new version of the database aside from the one in use and swapping it in.
+
+The crawl fills a staging database file, which is checked, gets exam numbers of the live
+database and then replaces it with a rename. Readers never see a partially filled
+database, and the replaced one is kept in the versions directory for a rollback.
+"""
+
+import os
+import shutil
+from collections.abc import AsyncIterator, Awaitable, Callable
+from contextlib import asynccontextmanager
+from datetime import datetime
+from pathlib import Path
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..misc import PathControl
+from .crawl_diff import bootstrap_crawl_state
+from .methods import refresh_facet_counts
+from .models import (
+    DATABASE_PATH,
+    Crawl,
+    CrawlDiffEntry,
+    CrawlProblemState,
+    CrawlProblemThemeState,
+    async_session,
+    register_models,
+    set_database_path,
+)
+
+DATABASE_VERSIONS_PATH = PathControl.get("../fipibank-versions")
+DEFAULT_KEEP_VERSIONS = 5
+# A subject may lose problems between crawls, but not most of them
+DEFAULT_MIN_ROWS_RATIO = 0.9
+
+_LIVE_SCHEMA = "live"
+_CRAWL_STATE_TABLE_NAMES = [
+    table.__tablename__
+    for table in (Crawl, CrawlDiffEntry, CrawlProblemState, CrawlProblemThemeState)
+]
+_SUBJECT_PROBLEMS_COUNTS_SQL = """
+SELECT gia_types.name, subjects.name, count(*)
+FROM {schema}.fipibank_problems AS problems
+JOIN {schema}.fipibank_problems_gia_types AS problem_gia_types
+    ON problem_gia_types.fipibank_problem_id = problems.id
+JOIN {schema}.gia_types AS gia_types ON gia_types.id = problem_gia_types.gia_type_id
+JOIN {schema}.fipibank_problems_subjects AS problem_subjects
+    ON problem_subjects.fipibank_problem_id = problems.id
+JOIN {schema}.subjects AS subjects ON subjects.id = problem_subjects.subject_id
+GROUP BY gia_types.name, subjects.name
+"""
+
+
+class DatabaseCheckError(Exception):
+    pass
+
+
+def get_staging_path(path: Path = DATABASE_PATH) -> Path:
+    return path.with_name(f"{path.stem}.staging{path.suffix}")
+
+
+async def _get_subject_problems_counts(
+    session: AsyncSession, schema: str
+) -> dict[tuple[str, str], int]:
+    rows = await session.execute(text(_SUBJECT_PROBLEMS_COUNTS_SQL.format(schema=schema)))
+    return {(gia_type, subject_name): count for gia_type, subject_name, count in rows}
+
+
+@asynccontextmanager
+async def _live_database_session(live_path: Path) -> AsyncIterator[AsyncSession]:
+    """Session of the staging database with the live one attached to its connection"""
+    async with async_session() as session:
+        # ATTACH can't run inside a transaction
+        await session.execute(
+            text(f"ATTACH DATABASE :path AS {_LIVE_SCHEMA}"), {"path": str(live_path)}
+        )
+        try:
+            yield session
+        finally:
+            await session.rollback()
+            await session.execute(text(f"DETACH DATABASE {_LIVE_SCHEMA}"))
+
+
+async def check_staging_database(
+    live_path: Path = DATABASE_PATH, min_rows_ratio: float = DEFAULT_MIN_ROWS_RATIO
+) -> dict[tuple[str, str], int]:
+    """
+    Checks the staging database, which the engine works with, before it replaces the live one.
+
+    Args:
+        - live_path: Live database, problems counts of its subjects are compared with the staging
+        - min_rows_ratio: Minimum ratio of staging to live problems count of every subject
+
+    Returns:
+        Problems counts of the staging database subjects
+
+    Raises:
+        DatabaseCheckError: If the database is corrupted, has problems without gia type
+        or subject, or lost too many problems of some subject
+    """
+    async with async_session() as session:
+        integrity_check_result = (await session.execute(text("PRAGMA integrity_check"))).scalar()
+        if integrity_check_result != "ok":
+            raise DatabaseCheckError(f"Integrity check failed: {integrity_check_result}")
+        foreign_key_errors = (await session.execute(text("PRAGMA foreign_key_check"))).fetchall()
+        if foreign_key_errors:
+            raise DatabaseCheckError(f"{len(foreign_key_errors)} rows reference missing rows")
+        orphans_count = (
+            await session.execute(
+                text(
+                    "SELECT count(*) FROM fipibank_problems WHERE id NOT IN "
+                    "(SELECT fipibank_problem_id FROM fipibank_problems_gia_types) OR id NOT IN "
+                    "(SELECT fipibank_problem_id FROM fipibank_problems_subjects)"
+                )
+            )
+        ).scalar()
+        if orphans_count:
+            raise DatabaseCheckError(f"{orphans_count} problems have no gia type or subject")
+        staging_counts = await _get_subject_problems_counts(session, "main")
+
+    if not staging_counts:
+        raise DatabaseCheckError("Staging database has no problems")
+    if not live_path.exists():  # noqa: ASYNC240 (a single stat call)
+        return staging_counts
+    async with _live_database_session(live_path) as session:
+        live_counts = await _get_subject_problems_counts(session, _LIVE_SCHEMA)
+    lost_subjects = [
+        f"{gia_type} {subject_name}: {staging_counts.get((gia_type, subject_name), 0)}"
+        f" problems instead of {live_count}"
+        for (gia_type, subject_name), live_count in live_counts.items()
+        if staging_counts.get((gia_type, subject_name), 0) < live_count * min_rows_ratio
+    ]
+    if lost_subjects:
+        raise DatabaseCheckError(
+            "Staging database lost problems, a staging build should crawl all subjects "
+            f"of the live one. {'; '.join(lost_subjects)}"
+        )
+    return staging_counts
+
+
+async def copy_live_data(live_path: Path = DATABASE_PATH) -> int:
+    """
+    Copies exam numbers, similar problems and exam number proposals of the live database
+    to the staging one.
+
+    Exam numbers are matched by problem id with one UPDATE ... FROM statement.
+
+    Returns:
+        Number of problems that got exam numbers
+    """
+    async with _live_database_session(live_path) as session:
+        labelled_problems_count = (
+            await session.execute(
+                text(
+                    "UPDATE fipibank_problems SET exam_number = live_problems.exam_number "  # noqa: S608
+                    f"FROM {_LIVE_SCHEMA}.fipibank_problems AS live_problems "
+                    "WHERE live_problems.problem_id = fipibank_problems.problem_id "
+                    "AND live_problems.exam_number IS NOT NULL"
+                )
+            )
+        ).rowcount
+        await session.execute(
+            text(
+                "INSERT OR IGNORE INTO fipibank_problem_neighbours "  # noqa: S608
+                f"SELECT * FROM {_LIVE_SCHEMA}.fipibank_problem_neighbours"
+            )
+        )
+        await session.execute(
+            text(
+                "INSERT OR IGNORE INTO exam_number_proposals "  # noqa: S608
+                f"SELECT * FROM {_LIVE_SCHEMA}.exam_number_proposals"
+            )
+        )
+        await session.commit()
+    return labelled_problems_count
+
+
+async def copy_live_crawl_state(live_path: Path = DATABASE_PATH) -> None:
+    """Copies crawl state and diffs history of the live database to the empty staging one"""
+    async with _live_database_session(live_path) as session:
+        for table_name in _CRAWL_STATE_TABLE_NAMES:
+            await session.execute(
+                text(f"INSERT INTO {table_name} SELECT * FROM {_LIVE_SCHEMA}.{table_name}")  # noqa: S608
+            )
+        await session.commit()
+
+
+def _save_version(path: Path, versions_path: Path) -> Path:
+    """Keep the current database file in the versions directory, hard linked if possible"""
+    versions_path.mkdir(parents=True, exist_ok=True)
+    version_path = versions_path / f"{path.stem}-{datetime.now():%Y%m%d-%H%M%S-%f}{path.suffix}"
+    try:
+        os.link(path, version_path)
+    except OSError:  # e.g. versions are on another file system
+        shutil.copy2(path, version_path)
+    return version_path
+
+
+def list_database_versions(
+    path: Path = DATABASE_PATH, versions_path: Path = DATABASE_VERSIONS_PATH
+) -> list[Path]:
+    """Return saved versions of the database, the newest first"""
+    if not versions_path.exists():
+        return []
+    return sorted(versions_path.glob(f"{path.stem}-*{path.suffix}"), reverse=True)
+
+
+def _remove_old_versions(path: Path, versions_path: Path, keep_versions: int) -> None:
+    for version_path in list_database_versions(path, versions_path)[keep_versions:]:
+        version_path.unlink()
+
+
+def swap_database(
+    staging_path: Path,
+    path: Path = DATABASE_PATH,
+    versions_path: Path = DATABASE_VERSIONS_PATH,
+    keep_versions: int = DEFAULT_KEEP_VERSIONS,
+) -> Path | None:
+    """Atomically replace the database with the staging one.
+
+    Returns the path the replaced database is kept at, None if there was no database.
+    """
+    previous_version_path = _save_version(path, versions_path) if path.exists() else None
+    staging_path.replace(path)
+    _remove_old_versions(path, versions_path, keep_versions)
+    return previous_version_path
+
+
+def rollback_database(
+    version_path: Path | None = None,
+    path: Path = DATABASE_PATH,
+    versions_path: Path = DATABASE_VERSIONS_PATH,
+) -> Path:
+    """
+    Atomically replace the database with one of its saved versions, the newest by default.
+
+    The replaced database is saved as a new version too, so a rollback can be undone.
+
+    Returns:
+        Path of the restored version
+    """
+    if version_path is None:
+        versions = list_database_versions(path, versions_path)
+        if not versions:
+            raise FileNotFoundError(f"No saved versions of {path} in {versions_path}")
+        version_path = versions[0]
+    tmp_path = path.with_name(f"{path.name}.rollback.tmp")
+    tmp_path.unlink(missing_ok=True)
+    shutil.copy2(version_path, tmp_path)
+    if path.exists():
+        _save_version(path, versions_path)
+    tmp_path.replace(path)
+    return version_path
+
+
+async def build_staging_database(
+    fill: Callable[[], Awaitable[None]],
+    path: Path = DATABASE_PATH,
+    resume: bool = False,
+    min_rows_ratio: float = DEFAULT_MIN_ROWS_RATIO,
+    versions_path: Path = DATABASE_VERSIONS_PATH,
+    keep_versions: int = DEFAULT_KEEP_VERSIONS,
+) -> None:
+    """
+    Builds a new version of the database in a staging file and swaps it in.
+
+    The database isn't swapped if any check fails, the staging file is left for inspection
+    and can be continued with resume=True.
+
+    Args:
+        - fill: Coroutine function filling the database the engine works with, e.g. a crawl
+        - path: Live database path
+        - resume: Continue filling the staging database left by a failed build
+        - min_rows_ratio: Minimum ratio of staging to live problems count of every subject
+        - versions_path: Directory previous database versions are kept in
+        - keep_versions: Number of previous database versions kept for a rollback
+    """
+    staging_path = get_staging_path(path)
+    if not resume:
+        staging_path.unlink(missing_ok=True)
+    live_exists = path.exists()  # noqa: ASYNC240
+    if live_exists:
+        # The staging crawl is compared with the state of the live database
+        await register_models()
+        await bootstrap_crawl_state()
+    await set_database_path(staging_path)
+    try:
+        await register_models()
+        if live_exists and not resume:
+            await copy_live_crawl_state(path)
+        await fill()
+        staging_counts = await check_staging_database(path, min_rows_ratio)
+        if live_exists:
+            labelled_problems_count = await copy_live_data(path)
+            print(f"Copied exam numbers of {labelled_problems_count} problems")
+        await refresh_facet_counts()
+    finally:
+        # Closes the staging database connections before it's renamed
+        await set_database_path(path)
+    previous_version_path = swap_database(staging_path, path, versions_path, keep_versions)
+    print(f"Swapped in a database of {sum(staging_counts.values())} problems")
+    if previous_version_path is not None:
+        print(f"Previous database is kept at {previous_version_path}")
@@ -0,0 +1,3 @@
+from .__main__ import SNAPSHOT_PATH, export_snapshot, load_snapshot, open_snapshot
+
+__all__ = ["SNAPSHOT_PATH", "export_snapshot", "load_snapshot", "open_snapshot"]
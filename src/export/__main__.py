@@ -0,0 +1,124 @@
+import asyncio
+import shutil
+import time
+from pathlib import Path
+from typing import Any
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import typer
+
+from ..database.methods import stream_all_problems_with_details
+from ..misc import PathControl
+from ..utils import get_problem_text
+
+SNAPSHOT_PATH = PathControl.get("../fipibank-snapshot")
+PARTITION_COLUMNS = ["gia_type", "subject_name"]
+EXPORT_CHUNK_SIZE = 5000
+
+SNAPSHOT_SCHEMA = pa.schema(
+    [
+        pa.field("problem_id", pa.string()),
+        pa.field("gia_type", pa.string()),
+        pa.field("subject_name", pa.string()),
+        pa.field("exam_number", pa.int32()),
+        pa.field("url", pa.string()),
+        pa.field("themes", pa.list_(pa.string())),
+        pa.field("condition_html", pa.string()),
+        pa.field("condition_text", pa.string()),
+    ]
+)
+
+app = typer.Typer(pretty_exceptions_enable=False)
+
+
+def _problems_df_to_table(problems_df: pd.DataFrame) -> pa.Table:
+    return pa.table(
+        {
+            "problem_id": problems_df["problem_id"],
+            "gia_type": problems_df["gia_type"],
+            "subject_name": problems_df["subject_name"],
+            "exam_number": problems_df["exam_number"].astype("Int32"),
+            "url": problems_df["url"],
+            "themes": [themes.split(",") if themes else [] for themes in problems_df["themes"]],
+            "condition_html": problems_df["condition_html"],
+            "condition_text": [
+                get_problem_text(html, parser="selectolax")
+                for html in problems_df["condition_html"]
+            ],
+        },
+        schema=SNAPSHOT_SCHEMA,
+    )
+
+
+async def export_snapshot(path: Path = SNAPSHOT_PATH, chunk_size: int = EXPORT_CHUNK_SIZE) -> int:
+    """Write all problems to a parquet dataset partitioned by gia type and subject.
+
+    Problems are streamed from the database and written by chunks of chunk_size,
+    so memory usage doesn't grow with the bank size.
+    The snapshot is written next to the previous one and swapped in when complete,
+    so readers never see a partially written dataset. Returns the number of exported problems.
+    """
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+    problems_count = 0
+    chunk_index = 0
+    async for problems_df in stream_all_problems_with_details(chunk_size):
+        table = _problems_df_to_table(problems_df)
+        ds.write_dataset(
+            table,
+            tmp_path,
+            format="parquet",
+            partitioning=PARTITION_COLUMNS,
+            partitioning_flavor="hive",
+            basename_template=f"part-{chunk_index}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+        )
+        problems_count += table.num_rows
+        chunk_index += 1
+    shutil.rmtree(path, ignore_errors=True)
+    tmp_path.rename(path)
+    return problems_count
+
+
+def open_snapshot(path: Path = SNAPSHOT_PATH) -> ds.Dataset:
+    return ds.dataset(path, format="parquet", partitioning="hive")
+
+
+def load_snapshot(
+    path: Path = SNAPSHOT_PATH,
+    columns: list[str] | None = None,
+    filters: Any = None,
+) -> pd.DataFrame:
+    """Load the problem bank snapshot into a DataFrame.
+
+    Args:
+        - path: Snapshot directory written by export_snapshot.
+        - columns: Columns to read, all columns if None.
+        - filters: pyarrow filter expression or list of (column, op, value) tuples,
+          e.g. [("gia_type", "=", "ege"), ("exam_number", ">", 0)]. Filters on gia_type
+          and subject_name prune whole partitions, others are pushed down to row groups.
+
+    Returns:
+        DataFrame with the selected problems
+    """
+    table = pq.read_table(
+        path, columns=columns, filters=filters, memory_map=True, partitioning="hive"
+    )
+    return table.to_pandas()
+
+
+@app.command()
+def main(
+    path: Path = typer.Option(SNAPSHOT_PATH, "-o", "--output", help="Каталог для выгрузки"),  # noqa: B008
+):
+    t1 = time.perf_counter()
+    problems_count = asyncio.run(export_snapshot(path))
+    typer.echo(f"Выгружено {problems_count} задач в {path} за {time.perf_counter() - t1:.2f} с")
+
+
+if __name__ == "__main__":
+    app()
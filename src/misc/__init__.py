@@ -1,3 +1,4 @@
 from .path_control import PathControl
+from .profiling import Profiler, profiled, section, set_profile_dir
 
-__all__ = ["PathControl"]
+__all__ = ["PathControl", "Profiler", "profiled", "section", "set_profile_dir"]
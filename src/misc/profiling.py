@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+import cProfile
+import functools
+import inspect
+import io
+import os
+import pstats
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+PROFILE_DIR_ENV_VARIABLE = "FIPIBANK_PROFILE_DIR"
+_STATS_LINES_LIMIT = 40
+
+# Section name -> total seconds spent in it. Tasks and threads started inside
+# a timed block inherit the same dict, so their sections are summed up too.
+_timings: ContextVar[dict[str, float] | None] = ContextVar("timings", default=None)
+_profile_dir: Path | None = (
+    Path(os.environ[PROFILE_DIR_ENV_VARIABLE])
+    if os.environ.get(PROFILE_DIR_ENV_VARIABLE)
+    else None
+)
+
+
+@contextmanager
+def section(name: str) -> Iterator[None]:
+    """Add the time spent in the block to the section of the current timings, if any.
+
+    Sections of concurrent tasks overlap, so their total may exceed the wall time.
+    """
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    t1 = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - t1
+
+
+def start_timings() -> Token[dict[str, float] | None]:
+    """Start collecting section timings in the current context"""
+    return _timings.set({})
+
+
+def stop_timings(token: Token[dict[str, float] | None]) -> dict[str, float]:
+    """Stop collecting section timings started with the token and return them"""
+    timings = _timings.get() or {}
+    _timings.reset(token)
+    return timings
+
+
+def format_timings(timings: dict[str, float]) -> str:
+    return ", ".join(f"{name}: {seconds:.3f} s" for name, seconds in timings.items())
+
+
+class Profiler:
+    """cProfile of a block of code together with timings of its sections.
+
+    Usage:
+        with Profiler() as profiler:
+            ...
+        profiler.dump(path)
+    """
+
+    def __init__(self) -> None:
+        self._profile = cProfile.Profile()
+        self._token: Token[dict[str, float] | None] | None = None
+        self.timings: dict[str, float] = {}
+        self.total_time = 0.0
+
+    def __enter__(self) -> Profiler:
+        self._token = start_timings()
+        self._start_time = time.perf_counter()
+        self._profile.enable()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self._profile.disable()
+        self.total_time = time.perf_counter() - self._start_time
+        self.timings = stop_timings(self._token)
+
+    def dump(self, path: Path) -> None:
+        """Write the profile to path (open it with snakeviz or pstats) and a summary next to it"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._profile.dump_stats(path)
+        stats_stream = io.StringIO()
+        pstats.Stats(self._profile, stream=stats_stream).sort_stats(
+            pstats.SortKey.CUMULATIVE
+        ).print_stats(_STATS_LINES_LIMIT)
+        path.with_suffix(".txt").write_text(
+            f"Total: {self.total_time:.3f} s\n"
+            f"Sections: {format_timings(self.timings)}\n\n"
+            f"{stats_stream.getvalue()}",
+            encoding="utf-8",
+        )
+        print(f"Profile is written to {path}. Sections: {format_timings(self.timings)}")
+
+
+def set_profile_dir(path: Path | None) -> None:
+    """Profile every call of functions decorated with profiled into path, None to stop"""
+    global _profile_dir
+    _profile_dir = path
+
+
+def get_profile_path(name: str, profile_dir: Path) -> Path:
+    return profile_dir / f"{name}-{datetime.now():%Y%m%d-%H%M%S}.prof"
+
+
+def profiled[F: Callable[..., Any]](function: F) -> F:
+    """Profile calls of the (sync or async) function when a profile directory is set.
+
+    The directory is set with set_profile_dir or FIPIBANK_PROFILE_DIR environment variable.
+    Calls made while another profiler is running are not profiled separately.
+    """
+
+    def should_profile() -> bool:
+        return _profile_dir is not None and _timings.get() is None
+
+    if inspect.iscoroutinefunction(function):
+
+        @functools.wraps(function)
+        async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+            if not should_profile():
+                return await function(*args, **kwargs)
+            with Profiler() as profiler:
+                result = await function(*args, **kwargs)
+            profiler.dump(get_profile_path(function.__name__, _profile_dir))
+            return result
+
+        return async_wrapper  # type: ignore[return-value]
+
+    @functools.wraps(function)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        if not should_profile():
+            return function(*args, **kwargs)
+        with Profiler() as profiler:
+            result = function(*args, **kwargs)
+        profiler.dump(get_profile_path(function.__name__, _profile_dir))
+        return result
+
+    return wrapper  # type: ignore[return-value]
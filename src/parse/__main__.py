@@ -1,45 +1,77 @@
 from __future__ import annotations
 
 import asyncio
-import itertools
+import math
 import random
 import re
 import time
 import typing
+from pathlib import Path  # noqa: TC003 (typer resolves option annotations at runtime)
 from typing import Any
 from urllib.parse import urlencode, urljoin
 
 import aiohttp
 import typer
 from selectolax.parser import HTMLParser, Node
-from tqdm import tqdm
 
 from ..database import register_models, save_subject_problems
-from ..problem_types import ProblemData, ThemeData
-from .const import EGE_SUBJECT_NAMES, HEADERS, OGE_SUBJECT_NAMES
+from ..database.crawl_diff import bootstrap_crawl_state, record_crawl_diff
+from ..database.methods import (
+    clear_crawl_journal,
+    get_finished_crawl_units,
+    refresh_facet_counts,
+)
+from ..database.staging import build_staging_database
+from ..misc.profiling import Profiler, section
+from ..problem_types import CrawlUnit, ProblemData, ThemeData
+from .const import EGE_SUBJECT_NAMES, OGE_SUBJECT_NAMES
+from .session import TIMEOUT, ConnectionStats, ConnectorSettings, create_session
 
 if typing.TYPE_CHECKING:
+    from collections.abc import AsyncIterator
     from types import TracebackType
 
 app = typer.Typer(pretty_exceptions_enable=False)
 
+# Finished units waiting for the database, each of them is committed on its own
+_FINISHED_UNITS_QUEUE_SIZE = 1
+# Themes being downloaded or waiting to be taken by the consumer, per gia type
+DEFAULT_MAX_PENDING_THEMES = 16
+
+_FIRST_PAGE_NUMBER = 0
+# questions.php reports the number of found problems to the index page with this call
+_PROBLEMS_COUNT_PATTERN = re.compile(rb"setQCount\((\d+)\)")
+_IMAGE_FUNCTION_NAME = "ShowPictureQ"
+_IMAGE_URL_PATTERN = re.compile(rf"{_IMAGE_FUNCTION_NAME}\w{{0,3}}\('(.+?)'\)")
+
 
 class FipiBankClient:
     _FIPIBANK_API_PAGE_SIZE_LIMIT = 2**14
-    _TIMEOUT = 60
+    _DEFAULT_PAGE_SIZE = 500
+    _TIMEOUT = TIMEOUT
     _base_url: str = ""
     _base_index_url: str = ""
     _base_questions_url: str = ""
 
-    def __init__(self, gia_type: str) -> None:
+    def __init__(
+        self,
+        gia_type: str,
+        page_size: int = _DEFAULT_PAGE_SIZE,
+        session: aiohttp.ClientSession | None = None,
+    ) -> None:
+        """
+        Args:
+            - gia_type: "oge" or "ege"
+            - page_size: Number of problems on one of problems pages downloaded in parallel
+            - session: Session to share connection pool with other clients. It isn't closed
+              with the client. If None, the client creates and closes its own session
+        """
         self.set_gia_type(gia_type)
         self._gia_type = gia_type
+        self._page_size = min(page_size, self._FIPIBANK_API_PAGE_SIZE_LIMIT)
 
-        self._session = aiohttp.ClientSession(
-            connector=aiohttp.TCPConnector(ssl=False),  # disable ssl to connect to fipi.ru,
-            timeout=aiohttp.ClientTimeout(self._TIMEOUT),
-            headers=HEADERS,
-        )
+        self._owns_session = session is None
+        self._session = create_session() if session is None else session
 
     def set_gia_type(self, gia_type: str) -> None:
         if gia_type not in ["oge", "ege"]:
@@ -71,8 +103,18 @@ class FipiBankClient:
             data[id_str] = title
         return data
 
-    async def parse_and_save_all_problems(self, subject_names: list[str] | None = None) -> None:
-        t1 = time.perf_counter()
+    async def iter_theme_problems(
+        self,
+        subject_names: list[str] | None = None,
+        finished_units: set[CrawlUnit] | frozenset[CrawlUnit] = frozenset(),
+        max_pending_themes: int = DEFAULT_MAX_PENDING_THEMES,
+    ) -> AsyncIterator[tuple[CrawlUnit, list[ProblemData]]]:
+        """Download themes of subjects in parallel and yield their problems as themes finish.
+
+        Themes in finished_units are skipped. A theme starts downloading only when fewer
+        than max_pending_themes themes are downloading or waiting to be taken, so a slow
+        consumer holds the downloads back instead of letting finished themes pile up.
+        """
         subject_ids = await self.get_subject_ids()
         if subject_names:
             subject_ids = {
@@ -80,58 +122,67 @@ class FipiBankClient:
                 for subject_name, subject_hash in subject_ids.items()
                 if subject_name in subject_names
             }
-            print(f"Subjects to parse problems: {list(subject_ids.keys())}")
-        get_pages_htmls_tasks = []
-        subject_themes_data: dict[
-            str, dict[str, str]
-        ] = {}  # key -- hash, value -- themes_data dict
-        async with asyncio.TaskGroup() as tg:
+            print(f"Subjects to parse problems ({self._gia_type}): {list(subject_ids.keys())}")
+        pending_themes = asyncio.Semaphore(max_pending_themes)
+
+        async def get_theme_problems(
+            unit: CrawlUnit, subject_name: str, theme_data: ThemeData
+        ) -> tuple[CrawlUnit, list[ProblemData]]:
+            await pending_themes.acquire()
+            return await self._get_theme_problems(unit, subject_name, theme_data)
+
+        get_theme_problems_tasks: list[asyncio.Task[tuple[CrawlUnit, list[ProblemData]]]] = []
+        try:
             for subject_name, subject_hash in subject_ids.items():
                 themes_data = await self.get_theme_names_and_ids(subject_hash=subject_hash)
-                subject_themes_data[subject_hash] = themes_data
-                for theme_codifier_id, theme_name in themes_data.items():
-                    get_pages_htmls_tasks.append(
-                        tg.create_task(
-                            self._get_subject_problems_html(
-                                subject_hash=subject_hash, theme_ids=[theme_codifier_id]
-                            )
-                        )
+                # Theme table of the subject, its records are shared by all problems of a theme
+                subject_themes = {
+                    theme_codifier_id: ThemeData(codifier_id=theme_codifier_id, name=theme_name)
+                    for theme_codifier_id, theme_name in themes_data.items()
+                }
+                for theme_codifier_id, theme_data in subject_themes.items():
+                    unit = CrawlUnit(self._gia_type, subject_hash, theme_codifier_id)
+                    if unit in finished_units:
+                        continue
+                    get_theme_problems_tasks.append(
+                        asyncio.create_task(get_theme_problems(unit, subject_name, theme_data))
                     )
+            for next_finished_task in asyncio.as_completed(get_theme_problems_tasks):
+                yield await next_finished_task
+                # The consumer has taken the theme, so the next one can start downloading
+                pending_themes.release()
+        finally:
+            for task in get_theme_problems_tasks:
+                task.cancel()
+
+    async def parse_all_problems(
+        self, subject_names: list[str] | None = None
+    ) -> list[ProblemData]:
+        problems: dict[str, ProblemData] = {}  # key -- problem id
+        async for _, theme_problems in self.iter_theme_problems(subject_names):
+            for problem_data in theme_problems:
+                if problem_data.problem_id in problems:
+                    # Problem belongs to several themes
+                    problems[problem_data.problem_id].themes += problem_data.themes
+                else:
+                    problems[problem_data.problem_id] = problem_data
+        return list(problems.values())
 
-        pages_htmls: list[str] = [i.result() for i in get_pages_htmls_tasks]
-
-        print("Got all htmls. Started parsing them")
-
-        all_problems = []
-
-        for subject_name, subject_hash in tqdm(
-            subject_ids.items(), desc="Parsing subjects problems"
-        ):
-            themes_data = subject_themes_data[subject_hash]
-            subject_problems_list: list[ProblemData] = []  # Store problems for current subject
-            for html, (theme_codifier_id, theme_name) in zip(
-                pages_htmls, themes_data.items(), strict=False
-            ):
-                subject_problems: list[ProblemData] = self._parse_subject_problems_from_html(
-                    html, subject_name, subject_hash
-                )
-                for subject_problem in subject_problems:
-                    subject_problem.themes = [
-                        ThemeData(codifier_id=theme_codifier_id, name=theme_name)
-                    ]
-                subject_problems_list.extend(subject_problems)
-
-            # Process and set themes for each problem in the subject
-            for problem_data in subject_problems_list:
-                all_problem_themes = self._get_all_problem_themes_data(
-                    problem_data, subject_problems_list
-                )
-                problem_data.themes = all_problem_themes
-                all_problems.append(problem_data)
+    async def parse_and_save_all_problems(self, subject_names: list[str] | None = None) -> None:
+        t1 = time.perf_counter()
+        all_problems = await self.parse_all_problems(subject_names)
+        await bootstrap_crawl_state()
         await save_subject_problems(all_problems)
+        _print_crawl_diff(await record_crawl_diff([self._gia_type]))
+        await refresh_facet_counts()
         print(f"Total time: {time.perf_counter() - t1: .2f}")
 
-    async def _get(self, url: str, params: dict[str, Any] | None = None) -> str:
+    async def _get(self, url: str, params: dict[str, Any] | None = None) -> bytes:
+        """Return raw response body.
+
+        It isn't transcoded: selectolax decodes it with the charset of the page meta tag,
+        so utf-8 bytes of a windows-1251 page would be decoded as windows-1251 again.
+        """
         if not params:
             params = {}
         try:
@@ -144,7 +195,7 @@ class FipiBankClient:
                     print(f"Retrying {response.url}. Sleeping for {delay_between_retry} s.")
                     await asyncio.sleep(delay_between_retry)
                     return await self._get(url=url, params=params)
-                return await response.text()
+                return await response.read()
         except (TimeoutError, aiohttp.ServerDisconnectedError):
             delay_between_retry = random.uniform(7.5, 15)
             print(
@@ -155,84 +206,118 @@ class FipiBankClient:
             return await self._get(url=url, params=params)
 
     def _get_problem_data_from_tag(
-        self, problem_tag: HTMLParser | Node, subject_name: str, subject_hash: str, gia_type: str
+        self, problem_tag: Node, subject_name: str, subject_hash: str, gia_type: str
     ) -> ProblemData:
-        problem_id = problem_tag.css_first("div.qblock").attributes["id"].lstrip("q")
+        problem_id = problem_tag.attributes["id"].lstrip("q")
         condition_html = problem_tag.html
 
-        condition_file_urls = []
-        script_tags = problem_tag.css("script")
-        image_url_pattern = re.compile(r"ShowPictureQ\w{0,3}\('(.+?)'\)")
-        for script_tag in script_tags:
-            script_content = script_tag.text()
-            image_urls = re.findall(image_url_pattern, script_content)
-            if image_urls:
-                for image_url in image_urls:
-                    image_url = urljoin(
-                        self._base_url, image_url.removeprefix("../../").removesuffix("','")
-                    )
-                    condition_file_urls.append(image_url)
+        # Most problems have no images, so skip looking for scripts in them
+        condition_file_urls: tuple[str, ...] = ()
+        if _IMAGE_FUNCTION_NAME in condition_html:
+            condition_file_urls = tuple(
+                urljoin(self._base_url, image_url.removeprefix("../../").removesuffix("','"))
+                for script_tag in problem_tag.css("script")
+                for image_url in _IMAGE_URL_PATTERN.findall(script_tag.text())
+            )
 
-        url = f"{self._base_questions_url}?search=1&proj={subject_hash}&qid={problem_id}"
         return ProblemData(
             problem_id=problem_id,
             subject_name=subject_name,
             subject_hash=subject_hash,
-            url=url,
+            questions_url=self._base_questions_url,
             gia_type=gia_type,
             condition_html=condition_html,
             file_urls=condition_file_urls,
-            themes=[],
+            themes=(),
         )
 
-    async def _get_subject_problems_html(
+    async def _get_subject_problems_pages(
         self, subject_hash: str, *, theme_ids: list[str] | None = None
-    ) -> str:
+    ) -> list[bytes]:
+        """Download all pages of the problems list in parallel"""
         params = {
             "search": 1,
-            "pagesize": self._FIPIBANK_API_PAGE_SIZE_LIMIT,
+            "pagesize": self._page_size,
             "proj": subject_hash,
             "theme": ",".join(theme_ids) if theme_ids else "",
         }
 
-        return await self._get(url=self._base_questions_url, params=params)
+        first_page_html = await self._get(
+            url=self._base_questions_url, params=params | {"page": _FIRST_PAGE_NUMBER}
+        )
+        problems_count_match = _PROBLEMS_COUNT_PATTERN.search(first_page_html)
+        if problems_count_match is None:
+            # Unknown problems count, fall back to requesting everything at once
+            return [
+                await self._get(
+                    url=self._base_questions_url,
+                    params=params | {"pagesize": self._FIPIBANK_API_PAGE_SIZE_LIMIT},
+                )
+            ]
+        pages_count = math.ceil(int(problems_count_match.group(1)) / self._page_size)
+        other_pages_htmls = await asyncio.gather(
+            *(
+                self._get(url=self._base_questions_url, params=params | {"page": page_number})
+                for page_number in range(_FIRST_PAGE_NUMBER + 1, _FIRST_PAGE_NUMBER + pages_count)
+            )
+        )
+        return [first_page_html, *other_pages_htmls]
+
+    async def _get_theme_problems(
+        self, unit: CrawlUnit, subject_name: str, theme_data: ThemeData
+    ) -> tuple[CrawlUnit, list[ProblemData]]:
+        with section("download"):
+            pages_htmls = await self._get_subject_problems_pages(
+                subject_hash=unit.subject_hash, theme_ids=[unit.codifier_id]
+            )
+        with section("parse"):
+            theme_problems = self._parse_subject_problems_from_pages(
+                pages_htmls, subject_name, unit.subject_hash
+            )
+            themes = (theme_data,)
+            for problem_data in theme_problems:
+                problem_data.themes = themes
+        return unit, theme_problems
 
-    def _parse_subject_problems_from_html(
-        self, html: str, subject_name: str, subject_hash: str
+    def _parse_subject_problems_from_pages(
+        self, pages_htmls: list[bytes] | list[str], subject_name: str, subject_hash: str
     ) -> list[ProblemData]:
-        doc = HTMLParser(html)
+        """Parse pages of a problems list one by one.
+
+        Every page ends with an empty card, so stitched pages would pair it with a header
+        card starting the next page.
+        """
+        return [
+            problem_data
+            for html in pages_htmls
+            for problem_data in self._parse_subject_problems_from_html(
+                html, subject_name, subject_hash
+            )
+        ]
 
-        problem_cards = doc.css("div.qblock")
+    def _parse_subject_problems_from_html(
+        self, html: bytes | str, subject_name: str, subject_hash: str
+    ) -> list[ProblemData]:
+        problem_cards = HTMLParser(html).css("div.qblock")
 
-        skip_next_card = False
+        # A card without id is a header of the next card, which holds the problem itself.
+        # The last card is never a problem on its own, as it has no card to pair with.
         problems_data_list: list[ProblemData] = []
-        for first_card_tag, second_card_tag in itertools.pairwise(problem_cards):
-            if skip_next_card:
-                skip_next_card = False
-                continue
-            id_tag_text = first_card_tag.attributes.get("id")
-            if id_tag_text is None:
-                problem_tag = second_card_tag
-                second_card_tag.insert_before(first_card_tag)
-                skip_next_card = True
+        card_index = 0
+        last_card_index = len(problem_cards) - 1
+        while card_index < last_card_index:
+            problem_tag = problem_cards[card_index]
+            if "id" in problem_tag.attributes:
+                card_index += 1
             else:
-                problem_tag = first_card_tag
+                problem_tag = problem_cards[card_index + 1]
+                card_index += 2
             problem_data = self._get_problem_data_from_tag(
                 problem_tag, subject_name, subject_hash, self._gia_type
             )
             problems_data_list.append(problem_data)
         return problems_data_list
 
-    @staticmethod
-    def _get_all_problem_themes_data(
-        problem_data: ProblemData, subject_problems: list[ProblemData]
-    ) -> list[ThemeData]:
-        all_problem_themes = []
-        for prob in subject_problems:
-            if prob.problem_id == problem_data.problem_id:
-                all_problem_themes.extend(prob.themes)
-        return all_problem_themes
-
     async def __aenter__(self) -> FipiBankClient:
         return self
 
@@ -242,13 +327,103 @@ class FipiBankClient:
         exc_value: BaseException | None,
         traceback: TracebackType | None,
     ) -> None:
-        await self._session.close()
+        if self._owns_session:
+            await self._session.close()
+
+
+def _print_crawl_diff(changes_count: dict[str, int]) -> None:
+    if not changes_count:
+        print("No problems changed since the previous crawl")
+        return
+    print(
+        "Changes since the previous crawl: "
+        + ", ".join(f"{change} {count}" for change, count in changes_count.items())
+    )
+
+
+async def _save_finished_units(
+    finished_units_queue: asyncio.Queue[tuple[CrawlUnit, list[ProblemData]] | None],
+    producers_count: int,
+) -> None:
+    """Save problems of every finished crawl unit together with its journal row as it comes"""
+    finished_producers_count = 0
+    saved_units_count = 0
+    while finished_producers_count < producers_count:
+        item = await finished_units_queue.get()
+        if item is None:
+            finished_producers_count += 1
+            continue
+        unit, unit_problems = item
+        with section("save"):
+            await save_subject_problems(unit_problems, finished_units=[unit])
+        saved_units_count += 1
+        print(
+            f"Saved {saved_units_count} themes, "
+            f"{len(unit_problems)} problems of theme {unit.codifier_id}"
+        )
 
 
-async def download_subjects(gia_type: str, subjects: list[str]):
+async def _put_finished_units(
+    client: FipiBankClient,
+    subject_names: list[str],
+    finished_units: set[CrawlUnit],
+    finished_units_queue: asyncio.Queue[tuple[CrawlUnit, list[ProblemData]] | None],
+) -> None:
+    async for item in client.iter_theme_problems(subject_names, finished_units):
+        await finished_units_queue.put(item)
+    await finished_units_queue.put(None)
+
+
+async def download_subjects(
+    subjects: dict[str, list[str]],
+    page_size: int = FipiBankClient._DEFAULT_PAGE_SIZE,
+    connector_settings: ConnectorSettings | None = None,
+    resume: bool = False,
+) -> None:
+    """
+    Download and save problems of several gia types concurrently over one connection pool.
+
+    Every theme of a subject is a crawl unit. Every finished unit is committed at once
+    together with its crawl journal record, so an interrupted crawl continued with
+    resume=True downloads again only the units that were in flight.
+
+    Args:
+        - subjects: Gia type ("oge" or "ege") to names of its subjects to download
+        - page_size: Number of problems on one of problems pages downloaded in parallel
+        - connector_settings: Connection pool settings
+        - resume: Skip units finished by the previous crawl, otherwise start from scratch
+    """
+    t1 = time.perf_counter()
     await register_models()
-    async with FipiBankClient(gia_type.lower()) as client:
-        await client.parse_and_save_all_problems(subject_names=subjects)
+    await bootstrap_crawl_state()
+    gia_types = list(subjects)
+    if resume:
+        finished_units = await get_finished_crawl_units(gia_types)
+        print(f"Resuming crawl, {len(finished_units)} themes are already saved")
+    else:
+        await clear_crawl_journal(gia_types)
+        finished_units = set()
+
+    connection_stats = ConnectionStats()
+    # Bounded, and iter_theme_problems downloads only a few themes ahead of its consumer,
+    # so downloads wait for the database instead of piling up in memory
+    finished_units_queue: asyncio.Queue[tuple[CrawlUnit, list[ProblemData]] | None] = (
+        asyncio.Queue(maxsize=_FINISHED_UNITS_QUEUE_SIZE)
+    )
+    async with (
+        create_session(connector_settings, connection_stats) as session,
+        asyncio.TaskGroup() as tg,
+    ):
+        for gia_type, subject_names in subjects.items():
+            client = FipiBankClient(gia_type.lower(), page_size=page_size, session=session)
+            tg.create_task(
+                _put_finished_units(client, subject_names, finished_units, finished_units_queue)
+            )
+        tg.create_task(_save_finished_units(finished_units_queue, len(subjects)))
+    _print_crawl_diff(await record_crawl_diff(gia_types))
+    await refresh_facet_counts()
+    print(f"Connections: {connection_stats}")
+    print(f"Total time: {time.perf_counter() - t1: .2f}")
 
 
 @app.command()
@@ -260,6 +435,43 @@ def main(
     oge: bool = typer.Option(False, "--oge", help="Загрузить задачи ОГЭ по выбранным предметам"),
     ege: bool = typer.Option(False, "--ege", help="Загрузить задачи EГЭ по выбранным предметам"),
     all_: bool = typer.Option(False, "--all", help="Загрузить все предметы"),
+    page_size: int = typer.Option(
+        FipiBankClient._DEFAULT_PAGE_SIZE,
+        "--page_size",
+        help="Количество задач на одной странице, загружаемой параллельно с остальными",
+    ),
+    limit: int = typer.Option(
+        ConnectorSettings.limit, "--limit", help="Максимальное число одновременных соединений"
+    ),
+    limit_per_host: int = typer.Option(
+        ConnectorSettings.limit_per_host,
+        "--limit_per_host",
+        help="Максимальное число одновременных соединений с одним сайтом",
+    ),
+    keepalive_timeout: float = typer.Option(
+        ConnectorSettings.keepalive_timeout,
+        "--keepalive_timeout",
+        help="Время (в секундах), в течение которого неиспользуемое соединение остаётся открытым",
+    ),
+    resume: bool = typer.Option(
+        False, "--resume", help="Продолжить прерванную загрузку с последней сохранённой темы"
+    ),
+    dns_cache_ttl: int = typer.Option(
+        ConnectorSettings.ttl_dns_cache,
+        "--dns_cache_ttl",
+        help="Время (в секундах) хранения адресов в кэше DNS",
+    ),
+    staging: bool = typer.Option(
+        False,
+        "--staging",
+        help="Загрузить задачи в отдельную базу данных и после проверок заменить ею текущую",
+    ),
+    profile: Path | None = typer.Option(  # noqa: B008
+        None,
+        "--profile",
+        help="Записать профиль загрузки (cProfile и время скачивания, разбора и сохранения) "
+        "в указанный файл",
+    ),
 ):
     gia_types_to_download = []
     if oge:
@@ -277,6 +489,7 @@ def main(
             "ЕГЭ": "ege",
         }
         gia_types_to_download.append(gia_type_eng[gia_type])
+    subjects_to_download: dict[str, list[str]] = {}
     for gia_type in gia_types_to_download:
         subject_list = OGE_SUBJECT_NAMES if gia_type == "oge" else EGE_SUBJECT_NAMES
 
@@ -300,8 +513,30 @@ def main(
                 raise typer.Exit(code=1)  # noqa: B904
 
         typer.echo(f"Загрузка предметов ({gia_type}): {', '.join(selected_subjects)}")
+        subjects_to_download[gia_type] = selected_subjects
+
+    connector_settings = ConnectorSettings(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        keepalive_timeout=keepalive_timeout,
+        ttl_dns_cache=dns_cache_ttl,
+    )
+
+    async def download() -> None:
+        await download_subjects(
+            subjects_to_download,
+            page_size,
+            connector_settings,
+            resume=resume,
+        )
 
-        asyncio.run(download_subjects(gia_type, selected_subjects))
+    download_coroutine = build_staging_database(download, resume=resume) if staging else download()
+    if profile is None:
+        asyncio.run(download_coroutine)
+        return
+    with Profiler() as profiler:
+        asyncio.run(download_coroutine)
+    profiler.dump(profile)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,350 @@
+"""Parity check and benchmark of problem extraction on recorded questions.php pages.
+
+Usage: python -m src.parse.benchmark --gia_type ege page1.html page2.html ...
+
+Without pages, the check runs on the pages recorded in src/parse/fixtures (just check).
+Pages named <name>_<page number>.html are pages of one problems list and are parsed together,
+as the crawl parses pages of a theme.
+
+With --memory, recordings are taken as themes of one subject (the recording name is the theme
+codifier id), and memory held by their problem records is measured for the legacy and
+the current record layouts. Pages of every theme of a subject are recorded with
+python -m src.parse.record.
+"""
+
+import asyncio
+import itertools
+import re
+import time
+import tracemalloc
+from collections.abc import Callable
+from dataclasses import dataclass
+from pathlib import Path
+from urllib.parse import urljoin
+
+import typer
+from aiohttp import web
+from selectolax.parser import HTMLParser, Node
+
+from ..misc import PathControl
+from ..problem_types import ProblemData, ThemeData
+from .__main__ import FipiBankClient
+
+app = typer.Typer(pretty_exceptions_enable=False)
+
+FIXTURES_PATH = PathControl.get("parse/fixtures")
+
+_META_CHARSET_PATTERN = re.compile(rb"<meta[^>]+charset=[\"']?([\w-]+)", re.IGNORECASE)
+
+
+@dataclass
+class _LegacyThemeData:
+    codifier_id: str
+    name: str
+
+
+@dataclass
+class _LegacyProblemData:
+    """Record layout used before the compact ProblemData"""
+
+    problem_id: str
+    subject_name: str
+    subject_hash: str
+    url: str
+    condition_html: str
+    gia_type: str
+    file_urls: list[str]
+    themes: list[_LegacyThemeData]
+
+
+def _to_legacy_problem_data(problem_data: ProblemData) -> _LegacyProblemData:
+    return _LegacyProblemData(
+        problem_id=problem_data.problem_id,
+        subject_name=problem_data.subject_name,
+        subject_hash=problem_data.subject_hash,
+        url=problem_data.url,
+        condition_html=problem_data.condition_html,
+        gia_type=problem_data.gia_type,
+        file_urls=list(problem_data.file_urls),
+        themes=[
+            _LegacyThemeData(codifier_id=theme_data.codifier_id, name=theme_data.name)
+            for theme_data in problem_data.themes
+        ],
+    )
+
+
+def _legacy_get_problem_data_from_tag(
+    client: FipiBankClient,
+    problem_tag: HTMLParser | Node,
+    subject_name: str,
+    subject_hash: str,
+    gia_type: str,
+) -> _LegacyProblemData:
+    """Reference implementation, the one used before the single pass extractor"""
+    problem_id = problem_tag.css_first("div.qblock").attributes["id"].lstrip("q")
+    condition_html = problem_tag.html
+
+    condition_file_urls = []
+    script_tags = problem_tag.css("script")
+    image_url_pattern = re.compile(r"ShowPictureQ\w{0,3}\('(.+?)'\)")
+    for script_tag in script_tags:
+        script_content = script_tag.text()
+        image_urls = re.findall(image_url_pattern, script_content)
+        if image_urls:
+            for image_url in image_urls:
+                image_url = urljoin(
+                    client._base_url, image_url.removeprefix("../../").removesuffix("','")
+                )
+                condition_file_urls.append(image_url)
+
+    url = f"{client._base_questions_url}?search=1&proj={subject_hash}&qid={problem_id}"
+    return _LegacyProblemData(
+        problem_id=problem_id,
+        subject_name=subject_name,
+        subject_hash=subject_hash,
+        url=url,
+        gia_type=gia_type,
+        condition_html=condition_html,
+        file_urls=condition_file_urls,
+        themes=[],
+    )
+
+
+def _legacy_parse_subject_problems_from_html(
+    client: FipiBankClient, html: str, subject_name: str, subject_hash: str
+) -> list[_LegacyProblemData]:
+    doc = HTMLParser(html)
+
+    problem_cards = doc.css("div.qblock")
+
+    skip_next_card = False
+    problems_data_list: list[_LegacyProblemData] = []
+    for first_card_tag, second_card_tag in itertools.pairwise(problem_cards):
+        if skip_next_card:
+            skip_next_card = False
+            continue
+        id_tag_text = first_card_tag.attributes.get("id")
+        if id_tag_text is None:
+            problem_tag = second_card_tag
+            second_card_tag.insert_before(first_card_tag)
+            skip_next_card = True
+        else:
+            problem_tag = first_card_tag
+        problem_data = _legacy_get_problem_data_from_tag(
+            client, problem_tag, subject_name, subject_hash, client._gia_type
+        )
+        problems_data_list.append(problem_data)
+    return problems_data_list
+
+
+def _legacy_parse_subject_problems_from_pages(
+    client: FipiBankClient, pages_htmls: list[str], subject_hash: str
+) -> list[_LegacyProblemData]:
+    return [
+        problem_data
+        for html in pages_htmls
+        for problem_data in _legacy_parse_subject_problems_from_html(
+            client, html, "", subject_hash
+        )
+    ]
+
+
+def _group_pages(pages_paths: list[Path]) -> dict[str, list[Path]]:
+    """Group pages of every recording, named <name>_<page number>.html, in page order"""
+    recordings: dict[str, list[tuple[int, Path]]] = {}
+    for page_path in pages_paths:
+        name, _, page_number = page_path.stem.rpartition("_")
+        if not name or not page_number.isdigit():
+            name, page_number = page_path.stem, "0"
+        recordings.setdefault(name, []).append((int(page_number), page_path))
+    return {
+        name: [page_path for _, page_path in sorted(pages)] for name, pages in recordings.items()
+    }
+
+
+def _decode_pages(pages_bytes: list[bytes], charsets: list[str]) -> list[str]:
+    return [
+        html_bytes.decode(charset)
+        for html_bytes, charset in zip(pages_bytes, charsets, strict=True)
+    ]
+
+
+def _get_page_charset(html_bytes: bytes) -> str:
+    charset_match = _META_CHARSET_PATTERN.search(html_bytes)
+    return charset_match.group(1).decode() if charset_match else "utf-8"
+
+
+async def _get_served_page(client: FipiBankClient, html_bytes: bytes, charset: str) -> bytes:
+    """Download the page with client._get from a local server declaring its charset"""
+    server_app = web.Application()
+    server_app.router.add_get(
+        "/", lambda _: web.Response(body=html_bytes, content_type="text/html", charset=charset)
+    )
+    runner = web.AppRunner(server_app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    try:
+        host, port = runner.addresses[0][:2]
+        return await client._get(f"http://{host}:{port}/")
+    finally:
+        await runner.cleanup()
+
+
+def _best_time(function: Callable[..., object], args: tuple, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - t1)
+    return min(timings)
+
+
+async def run_benchmark(
+    gia_type: str, pages_paths: list[Path], repeat: int, subject_hash: str
+) -> bool:
+    all_pages_match = True
+    async with FipiBankClient(gia_type) as client:
+        for name, recording_paths in _group_pages(pages_paths).items():
+            pages_bytes = [page_path.read_bytes() for page_path in recording_paths]
+            charsets = [_get_page_charset(html_bytes) for html_bytes in pages_bytes]
+            pages_htmls = _decode_pages(pages_bytes, charsets)
+            legacy_problems = _legacy_parse_subject_problems_from_pages(
+                client, pages_htmls, subject_hash
+            )
+            problems = client._parse_subject_problems_from_pages(pages_bytes, "", subject_hash)
+            # Pages are parsed as downloaded too, so a charset mismatch
+            # between the response body and its meta tag shows up
+            downloaded_problems = client._parse_subject_problems_from_pages(
+                [
+                    await _get_served_page(client, html_bytes, charset)
+                    for html_bytes, charset in zip(pages_bytes, charsets, strict=True)
+                ],
+                "",
+                subject_hash,
+            )
+            pages_match = (
+                [_to_legacy_problem_data(problem_data) for problem_data in problems]
+                == [_to_legacy_problem_data(problem_data) for problem_data in downloaded_problems]
+                == legacy_problems
+            )
+            all_pages_match &= pages_match
+
+            legacy_time = _best_time(
+                _legacy_parse_subject_problems_from_pages,
+                (client, pages_htmls, subject_hash),
+                repeat,
+            )
+            str_time = _best_time(
+                client._parse_subject_problems_from_pages, (pages_htmls, "", subject_hash), repeat
+            )
+            bytes_time = _best_time(
+                client._parse_subject_problems_from_pages, (pages_bytes, "", subject_hash), repeat
+            )
+            decode_time = _best_time(_decode_pages, (pages_bytes, charsets), repeat)
+            print(
+                f"{name}: {len(recording_paths)} pages, {len(problems)} problems, "
+                f"parity {'OK' if pages_match else 'FAILED'}, "
+                f"legacy {legacy_time * 1000:.1f} ms, "
+                f"single pass {str_time * 1000:.1f} ms (+{decode_time * 1000:.1f} ms decoding), "
+                f"single pass from bytes {bytes_time * 1000:.1f} ms, "
+                f"speedup x{(legacy_time + decode_time) / bytes_time:.2f}"
+            )
+    return all_pages_match
+
+
+def _legacy_parse_subject_problems(
+    client: FipiBankClient, themes_htmls: dict[str, list[bytes]]
+) -> list[_LegacyProblemData]:
+    """Problems of the subject themes as they were kept in memory by the legacy crawl"""
+    problems: dict[str, _LegacyProblemData] = {}
+    for codifier_id, pages_bytes in themes_htmls.items():
+        pages_htmls = _decode_pages(
+            pages_bytes, [_get_page_charset(html_bytes) for html_bytes in pages_bytes]
+        )
+        for problem_data in _legacy_parse_subject_problems_from_pages(client, pages_htmls, ""):
+            problem_data.themes = [_LegacyThemeData(codifier_id=codifier_id, name=codifier_id)]
+            if problem_data.problem_id in problems:
+                problems[problem_data.problem_id].themes.extend(problem_data.themes)
+            else:
+                problems[problem_data.problem_id] = problem_data
+    return list(problems.values())
+
+
+def _parse_subject_problems(
+    client: FipiBankClient, themes_htmls: dict[str, list[bytes]]
+) -> list[ProblemData]:
+    """Problems of the subject themes as they are kept in memory by the crawl"""
+    problems: dict[str, ProblemData] = {}
+    subject_themes = {
+        codifier_id: ThemeData(codifier_id=codifier_id, name=codifier_id)
+        for codifier_id in themes_htmls
+    }
+    for codifier_id, pages_bytes in themes_htmls.items():
+        themes = (subject_themes[codifier_id],)
+        for problem_data in client._parse_subject_problems_from_pages(pages_bytes, "", ""):
+            problem_data.themes = themes
+            if problem_data.problem_id in problems:
+                problems[problem_data.problem_id].themes += problem_data.themes
+            else:
+                problems[problem_data.problem_id] = problem_data
+    return list(problems.values())
+
+
+def _held_memory(function: Callable[..., list], args: tuple) -> tuple[int, int, int]:
+    """Return number of records made by the function, memory held by them and peak memory"""
+    tracemalloc.start()
+    try:
+        records = function(*args)
+        held_memory, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return len(records), held_memory, peak_memory
+
+
+async def run_memory_benchmark(gia_type: str, pages_paths: list[Path]) -> None:
+    themes_htmls = {
+        codifier_id: [page_path.read_bytes() for page_path in recording_paths]
+        for codifier_id, recording_paths in _group_pages(pages_paths).items()
+    }
+    async with FipiBankClient(gia_type) as client:
+        for name, function in (
+            ("legacy", _legacy_parse_subject_problems),
+            ("compact", _parse_subject_problems),
+        ):
+            problems_count, held_memory, peak_memory = _held_memory(
+                function, (client, themes_htmls)
+            )
+            print(
+                f"{name}: {problems_count} problems hold {held_memory / 2**20:.2f} MiB "
+                f"({held_memory / problems_count:.0f} B per problem), "
+                f"peak {peak_memory / 2**20:.2f} MiB"
+            )
+
+
+@app.command()
+def main(
+    pages: list[Path] | None = typer.Argument(  # noqa: B008
+        None,
+        help="Сохранённые страницы questions.php, по умолчанию страницы из src/parse/fixtures",
+    ),
+    gia_type: str = typer.Option("ege", "--gia_type", help="Тип экзамена страниц"),
+    subject_hash: str = typer.Option("", "--subject_hash", help="Хэш предмета страниц"),
+    repeat: int = typer.Option(5, "-r", "--repeat", help="Количество повторов замера"),
+    memory: bool = typer.Option(
+        False,
+        "--memory",
+        help="Измерить память, занимаемую задачами страниц (страницы -- темы одного предмета)",
+    ),
+):
+    if not pages:
+        pages = sorted(FIXTURES_PATH.glob("*.html"))
+    if memory:
+        asyncio.run(run_memory_benchmark(gia_type, pages))
+        return
+    if not asyncio.run(run_benchmark(gia_type, pages, repeat, subject_hash)):
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
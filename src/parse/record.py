@@ -0,0 +1,63 @@
+"""Record questions.php pages of every theme of a subject.
+
+Usage: python -m src.parse.record --gia_type ege "Информатика и ИКТ" fipibank-pages/informatics
+
+Every page of a theme is saved to <codifier id>_<page number>.html in the directory, so the
+recording is taken by python -m src.parse.benchmark --memory fipibank-pages/informatics/*.html
+as a full subject.
+"""
+
+import asyncio
+from pathlib import Path
+
+import typer
+
+from .__main__ import FipiBankClient
+
+app = typer.Typer(pretty_exceptions_enable=False)
+
+
+async def get_subject_pages(
+    gia_type: str, subject_name: str, page_size: int
+) -> dict[str, list[bytes]]:
+    """Download pages of every theme of the subject, keyed by theme codifier id"""
+    async with FipiBankClient(gia_type, page_size=page_size) as client:
+        subject_ids = await client.get_subject_ids()
+        if subject_name not in subject_ids:
+            raise ValueError(
+                f"No subject {subject_name!r} in {gia_type}, only {list(subject_ids)}"
+            )
+        subject_hash = subject_ids[subject_name]
+        codifier_ids = list(await client.get_theme_names_and_ids(subject_hash=subject_hash))
+        themes_htmls = await asyncio.gather(
+            *(
+                client._get_subject_problems_pages(
+                    subject_hash=subject_hash, theme_ids=[codifier_id]
+                )
+                for codifier_id in codifier_ids
+            )
+        )
+    return dict(zip(codifier_ids, themes_htmls, strict=True))
+
+
+@app.command()
+def main(
+    subject_name: str = typer.Argument(..., help="Название предмета"),
+    pages_path: Path = typer.Argument(..., help="Папка для страниц тем предмета"),  # noqa: B008
+    gia_type: str = typer.Option("ege", "--gia_type", help="Тип экзамена предмета"),
+    page_size: int = typer.Option(
+        FipiBankClient._DEFAULT_PAGE_SIZE,
+        "--page_size",
+        help="Количество задач на одной странице, загружаемой параллельно",
+    ),
+):
+    subject_pages = asyncio.run(get_subject_pages(gia_type, subject_name, page_size))
+    pages_path.mkdir(parents=True, exist_ok=True)
+    for codifier_id, pages_htmls in subject_pages.items():
+        for page_number, html in enumerate(pages_htmls):
+            (pages_path / f"{codifier_id}_{page_number}.html").write_bytes(html)
+    typer.echo(f"Сохранены страницы {len(subject_pages)} тем в {pages_path}")
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import importlib.util
+import typing
+from dataclasses import dataclass
+
+import aiohttp
+
+from .const import HEADERS
+
+if typing.TYPE_CHECKING:
+    from types import SimpleNamespace
+
+TIMEOUT = 60
+# aiohttp decodes brotli only if one of brotli packages is installed
+ACCEPT_ENCODING = (
+    "gzip, br"
+    if importlib.util.find_spec("brotli") or importlib.util.find_spec("brotlicffi")
+    else "gzip"
+)
+
+
+@dataclass
+class ConnectorSettings:
+    limit: int = 100  # Total number of simultaneous connections
+    limit_per_host: int = 30  # Number of simultaneous connections to one of fipi.ru hosts
+    keepalive_timeout: float = 30  # Seconds to keep an idle connection open for reuse
+    ttl_dns_cache: int | None = 600  # Seconds to cache resolved addresses, None to cache forever
+
+
+@dataclass
+class ConnectionStats:
+    requests: int = 0
+    connections_created: int = 0
+    connections_reused: int = 0
+    dns_cache_hits: int = 0
+    dns_cache_misses: int = 0
+
+    def get_trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_end.append(self._on_request_end)
+        trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+        trace_config.on_dns_cache_hit.append(self._on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(self._on_dns_cache_miss)
+        return trace_config
+
+    @property
+    def reuse_ratio(self) -> float:
+        connections_count = self.connections_created + self.connections_reused
+        return self.connections_reused / connections_count if connections_count else 0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.requests} requests, {self.connections_created} connections created, "
+            f"{self.connections_reused} reused ({self.reuse_ratio:.0%}), "
+            f"DNS cache {self.dns_cache_hits} hits / {self.dns_cache_misses} misses"
+        )
+
+    async def _on_request_end(self, *_: SimpleNamespace) -> None:
+        self.requests += 1
+
+    async def _on_connection_create_end(self, *_: SimpleNamespace) -> None:
+        self.connections_created += 1
+
+    async def _on_connection_reuseconn(self, *_: SimpleNamespace) -> None:
+        self.connections_reused += 1
+
+    async def _on_dns_cache_hit(self, *_: SimpleNamespace) -> None:
+        self.dns_cache_hits += 1
+
+    async def _on_dns_cache_miss(self, *_: SimpleNamespace) -> None:
+        self.dns_cache_misses += 1
+
+
+def create_session(
+    settings: ConnectorSettings | None = None, stats: ConnectionStats | None = None
+) -> aiohttp.ClientSession:
+    """Create a session with keep-alive connection pool shared by ege.fipi.ru and oge.fipi.ru"""
+    if settings is None:
+        settings = ConnectorSettings()
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            ssl=False,  # disable ssl to connect to fipi.ru
+            limit=settings.limit,
+            limit_per_host=settings.limit_per_host,
+            keepalive_timeout=settings.keepalive_timeout,
+            use_dns_cache=True,
+            ttl_dns_cache=settings.ttl_dns_cache,
+        ),
+        timeout=aiohttp.ClientTimeout(TIMEOUT),
+        headers=HEADERS | {"Accept-Encoding": ACCEPT_ENCODING},
+        trace_configs=[stats.get_trace_config()] if stats is not None else None,
+    )
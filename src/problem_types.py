@@ -1,19 +1,53 @@
+import sys
 from dataclasses import dataclass
 
 
-@dataclass
+@dataclass(slots=True)
 class ThemeData:
+    """Theme of a subject, one object from the subject's theme table is shared by its problems"""
+
     codifier_id: str
     name: str
 
+    def __post_init__(self) -> None:
+        self.codifier_id = sys.intern(self.codifier_id)
+        self.name = sys.intern(self.name)
+
 
-@dataclass
+@dataclass(slots=True)
 class ProblemData:
+    """
+    Problem parsed from a problems page.
+
+    All problems of a crawl are kept in memory until they are saved, so the record has
+    no __dict__, strings repeated by every problem of a subject are interned, and the url
+    is built from them on access.
+    """
+
     problem_id: str
     subject_name: str
     subject_hash: str
-    url: str
+    questions_url: str
     condition_html: str
     gia_type: str
-    file_urls: list[str]
-    themes: list[ThemeData]
+    file_urls: tuple[str, ...]
+    themes: tuple[ThemeData, ...]
+
+    def __post_init__(self) -> None:
+        self.subject_name = sys.intern(self.subject_name)
+        self.subject_hash = sys.intern(self.subject_hash)
+        self.questions_url = sys.intern(self.questions_url)
+        self.gia_type = sys.intern(self.gia_type)
+
+    @property
+    def url(self) -> str:
+        return f"{self.questions_url}?search=1&proj={self.subject_hash}&qid={self.problem_id}"
+
+
+@dataclass(frozen=True)
+class CrawlUnit:
+    """Problems of one theme of a subject, downloaded and saved as a whole"""
+
+    gia_type: str
+    subject_hash: str
+    codifier_id: str
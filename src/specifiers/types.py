@@ -1,4 +1,6 @@
+from collections import defaultdict
 from dataclasses import dataclass
+from functools import cached_property
 
 
 @dataclass
@@ -16,3 +18,15 @@ class BaseSpecifier:
     subject_name: str
     year_of_publication: int
     problems: list[Problem]
+
+    @cached_property
+    def theme_to_exam_numbers(self) -> dict[str, frozenset[int]]:
+        """Content codifier theme id to exam numbers of problems checking it"""
+        theme_exam_numbers: defaultdict[str, set[int]] = defaultdict(set)
+        for problem in self.problems:
+            for theme_id in problem.content_codifier_theme_ids:
+                theme_exam_numbers[theme_id].add(problem.exam_number)
+        return {
+            theme_id: frozenset(exam_numbers)
+            for theme_id, exam_numbers in theme_exam_numbers.items()
+        }
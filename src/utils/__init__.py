@@ -1,3 +1,4 @@
+from ..misc import set_profile_dir
 from .__main__ import (
     create_cluster_id_to_exam_number_dict,
     get_problem_text,
@@ -9,15 +10,35 @@ from .__main__ import (
     set_exam_number,
     set_exam_number_from_clustered_df,
 )
+from .changes import get_changed_problems_df
+from .normalization import NormalizedTextCache, get_normalized_texts, normalize_text
+from .prelabel import get_candidate_exam_numbers, prelabel_problems
+from .propagation import get_knn_graph, propagate_exam_numbers, spread_labels
+from .similar import build_similar_problems_index, get_nearest_neighbours, get_problem_vectors
+from .streaming_clustering import stream_clusterize_problems
 
 __all__ = [
+    "NormalizedTextCache",
+    "build_similar_problems_index",
     "create_cluster_id_to_exam_number_dict",
+    "get_candidate_exam_numbers",
+    "get_changed_problems_df",
+    "get_knn_graph",
+    "get_nearest_neighbours",
+    "get_normalized_texts",
     "get_problem_text",
+    "get_problem_vectors",
     "get_theme_df",
+    "normalize_text",
+    "prelabel_problems",
     "print_all_exam_number_problems",
     "print_and_get_theme_clustered_df",
     "print_clustered_df",
     "print_theme_problem_condition",
+    "propagate_exam_numbers",
     "set_exam_number",
     "set_exam_number_from_clustered_df",
+    "set_profile_dir",
+    "spread_labels",
+    "stream_clusterize_problems",
 ]
@@ -4,18 +4,21 @@ from collections.abc import Coroutine
 from typing import Any, TypeVar
 
 import matplotlib.pyplot as plt
-import nltk
 import pandas as pd
 from bs4 import BeautifulSoup
-from nltk.corpus import stopwords
 from selectolax.parser import HTMLParser
 from sklearn.cluster import KMeans
 from sklearn.feature_extraction.text import TfidfVectorizer
 from tqdm import trange
 
-from ..database.methods import add_exam_number_to_problems, get_problems_with_details
-from ..misc import PathControl
+from ..database.methods import (
+    add_exam_number_to_problems,
+    get_problems_with_details,
+    set_exam_numbers,
+)
+from ..misc import profiled, section
 from ..specifiers import BaseSpecifier, informatics_specifier_2024
+from .normalization import get_normalized_texts, normalize_text
 
 T = TypeVar("T")
 
@@ -26,7 +29,8 @@ def _run_async[T](coroutine: Coroutine[Any, Any, T]) -> T:
 
 
 async def get_theme_df(
-    content_codifier_theme_id: str, specifier: BaseSpecifier = informatics_specifier_2024
+    content_codifier_theme_id: str | list[str],
+    specifier: BaseSpecifier = informatics_specifier_2024,
 ) -> pd.DataFrame:
     return await get_problems_with_details(
         gia_type=specifier.gia_type,
@@ -115,14 +119,21 @@ def clusterize_tasks_elbow_method(
     x_step: int = 1,
     y_step: int = 10,
 ) -> pd.DataFrame:
-    nltk.download("stopwords", download_dir=PathControl.get(".nltk-data"))
-    russian_stop_words = stopwords.words("russian")
+    # Callers which pass only "condition_text" get it normalized here
+    if "normalized_text" not in df:
+        if "problem_id" in df:
+            df["normalized_text"] = get_normalized_texts(df["problem_id"], df["condition_text"])
+        else:
+            df["normalized_text"] = df["condition_text"].apply(normalize_text)
 
-    # Create a TfidfVectorizer object to transform text data into numerical features
-    tfidf_vectorizer = TfidfVectorizer(min_df=2, stop_words=russian_stop_words)
+    # Create a TfidfVectorizer object to transform text data into numerical features.
+    # Texts are already normalized, so tokens are just whitespace separated stems and masks
+    tfidf_vectorizer = TfidfVectorizer(
+        min_df=2, lowercase=False, tokenizer=str.split, token_pattern=None
+    )
 
     # Transform text into numerical features
-    data = tfidf_vectorizer.fit_transform(df["condition_text"])
+    data = tfidf_vectorizer.fit_transform(df["normalized_text"])
 
     # Plot inertia graph for different numbers of clusters
     max_n_clusters_ = min(max_n_clusters + 1, len(df))
@@ -163,6 +174,7 @@ def clusterize_tasks_elbow_method(
     return df
 
 
+@profiled
 async def print_and_get_theme_clustered_df(
     content_codifier_theme_id: str | list[str],
     print_problem_clusters: bool = True,
@@ -176,39 +188,36 @@ async def print_and_get_theme_clustered_df(
     y_step: int = 10,
 ) -> pd.DataFrame:
     if df is None:
-        if isinstance(content_codifier_theme_id, str):
-            theme_df = await get_theme_df(content_codifier_theme_id=content_codifier_theme_id)
-        elif isinstance(content_codifier_theme_id, list):
-            theme_df = pd.concat(
-                [
-                    await get_theme_df(content_codifier_theme_id=theme_id)
-                    for theme_id in content_codifier_theme_id
-                ]
-            )
-        else:
+        if not isinstance(content_codifier_theme_id, str | list):
             raise ValueError(
                 f"content_codifier_theme_id should be str or list[str], not {type(content_codifier_theme_id)}"
             )
-
+        with section("db"):
+            theme_df = await get_theme_df(content_codifier_theme_id=content_codifier_theme_id)
     else:
         theme_df = df.copy()
     if theme_df.empty:
         raise ValueError(f"No problems in database with {content_codifier_theme_id=}")
-    theme_df["condition_text"] = theme_df["condition_html"].apply(
-        lambda html: get_problem_text(html=html)
-    )
+    with section("normalize"):
+        theme_df["condition_text"] = theme_df["condition_html"].apply(
+            lambda html: get_problem_text(html=html)
+        )
+        theme_df["normalized_text"] = get_normalized_texts(
+            theme_df["problem_id"], theme_df["condition_text"]
+        )
     theme_df.drop("condition_html", axis=1, inplace=True)
 
-    clustered_theme_df = clusterize_tasks_elbow_method(
-        df=theme_df,
-        max_n_clusters=max_n_clusters,
-        optimal_n_clusters=optimal_n_clusters,
-        x_ticks_rotation=x_ticks_rotation,
-        y_ticks_rotation=y_ticks_rotation,
-        horizontal_lines=horizontal_lines,
-        x_step=x_step,
-        y_step=y_step,
-    )
+    with section("cluster"):
+        clustered_theme_df = clusterize_tasks_elbow_method(
+            df=theme_df,
+            max_n_clusters=max_n_clusters,
+            optimal_n_clusters=optimal_n_clusters,
+            x_ticks_rotation=x_ticks_rotation,
+            y_ticks_rotation=y_ticks_rotation,
+            horizontal_lines=horizontal_lines,
+            x_step=x_step,
+            y_step=y_step,
+        )
     print(
         "Number of problems in clusters: "
         f"{clustered_theme_df['cluster_label'].value_counts(dropna=False).to_dict()}\n"
@@ -219,6 +228,7 @@ async def print_and_get_theme_clustered_df(
     return clustered_theme_df
 
 
+@profiled
 async def set_exam_number_from_clustered_df(
     clustered_df: pd.DataFrame,
     cluster_id_to_exam_number: dict[int, int],
@@ -255,15 +265,17 @@ async def set_exam_number_from_clustered_df(
             "match the set of unique cluster labels."
         )
 
-    grouped_df = clustered_df.groupby("cluster_label")
-
-    for cluster_label, cluster_data in grouped_df:
-        exam_number = cluster_id_to_exam_number[cluster_label]
-
-        problem_ids = cluster_data["problem_id"].tolist()
+    exam_numbers = dict(
+        zip(
+            clustered_df["problem_id"],
+            clustered_df["cluster_label"].map(cluster_id_to_exam_number),
+            strict=True,
+        )
+    )
+    updated_rows_count = await set_exam_numbers(exam_numbers)
 
-        await add_exam_number_to_problems(problem_ids=problem_ids, exam_number=exam_number)
-        print(f'Set "{exam_number}" exam number to {len(problem_ids)} problems.')
+    for exam_number, problems_count in updated_rows_count.items():
+        print(f'Set "{exam_number}" exam number to {problems_count} problems.')
 
 
 def create_cluster_id_to_exam_number_dict(
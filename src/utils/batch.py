@@ -0,0 +1,46 @@
+"""Batch jobs over the whole problem bank.
+
+Usage: python -m src.utils.batch similar --neighbours 10
+"""
+
+import asyncio
+
+import typer
+
+from .propagation import propagate_exam_numbers
+from .similar import build_similar_problems_index
+
+app = typer.Typer(pretty_exceptions_enable=False)
+
+
+@app.callback(help="Пакетные задачи над всем банком задач")
+def main():
+    pass
+
+
+@app.command(help="Пересчитать похожие задачи для /similar")
+def similar(
+    n_neighbours: int = typer.Option(
+        10, "--neighbours", help="Количество похожих задач, сохраняемых для каждой задачи"
+    ),
+    n_components: int | None = typer.Option(
+        None, "--components", help="Сократить размерность TF-IDF векторов до этого числа"
+    ),
+):
+    asyncio.run(build_similar_problems_index(n_neighbours, n_components))
+
+
+@app.command(help="Предложить типы задачам без типа по похожим размеченным задачам")
+def propagate(
+    n_neighbours: int = typer.Option(
+        10, "--neighbours", help="Количество ближайших задач, с которыми связана задача"
+    ),
+    min_similarity: float = typer.Option(
+        0.1, "--min_similarity", help="Минимальная косинусная близость связанных задач"
+    ),
+):
+    asyncio.run(propagate_exam_numbers(n_neighbours, min_similarity))
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,52 @@
+import pandas as pd
+
+from ..database.crawl_diff import get_crawl_diff
+from ..database.methods import get_problems_with_details_by_ids
+from ..database.models import CrawlChangeEnum
+
+DEFAULT_RELABEL_CHANGES = (
+    CrawlChangeEnum.added,
+    CrawlChangeEnum.changed,
+    CrawlChangeEnum.theme_added,
+    CrawlChangeEnum.theme_removed,
+)
+
+
+async def get_changed_problems_df(
+    crawl_id: int | None = None,
+    changes: tuple[CrawlChangeEnum, ...] = DEFAULT_RELABEL_CHANGES,
+    unlabelled_only: bool = False,
+) -> pd.DataFrame:
+    """
+    Returns problems that were added or changed by a crawl, to relabel only them.
+
+    The result can be passed as df to print_and_get_theme_clustered_df or its problem ids
+    to prelabel_problems.
+
+    Args:
+        - crawl_id: Crawl id, the last crawl if None
+        - changes: Kinds of changes to return problems with
+        - unlabelled_only: Skip changed problems that already have an exam number
+
+    Returns:
+        DataFrame with the columns of get_all_problems_with_details
+        and comma separated kinds of problem changes in "changes" column
+    """
+    diff_df = await get_crawl_diff(crawl_id)
+    diff_df = diff_df[diff_df["change"].isin([change.value for change in changes])]
+    problem_changes = (
+        diff_df.drop_duplicates(["problem_id", "change"])
+        .groupby("problem_id", sort=False)["change"]
+        .agg(",".join)
+    )
+    problems_df = (
+        (await get_problems_with_details_by_ids(problem_changes.index.tolist()))
+        .drop_duplicates("problem_id")
+        .reset_index(drop=True)
+    )
+    problems_df["changes"] = problems_df["problem_id"].map(problem_changes)
+    if unlabelled_only:
+        problems_df = problems_df[problems_df["exam_number"].isna()].reset_index(drop=True)
+    changes_count = problem_changes.str.split(",").explode().value_counts().to_dict()
+    print(f"{len(problems_df)} problems changed: {changes_count}")
+    return problems_df
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import re
+from collections.abc import Iterable
+from functools import cache, lru_cache
+from pathlib import Path
+
+import nltk
+from nltk.corpus import stopwords
+from nltk.stem.snowball import SnowballStemmer
+
+from ..misc import PathControl
+
+# Bump it whenever normalize_text output changes, so stale cached texts are rebuilt
+NORMALIZATION_VERSION = 1
+
+NUMBER_MASK = "__num__"
+VARIABLE_MASK = "__var__"
+
+NLTK_DATA_PATH = PathControl.get(".nltk-data")
+NORMALIZED_TEXTS_CACHE_PATH = PathControl.get(".cache/normalized-texts.json")
+
+_TOKEN_PATTERN = re.compile(r"[а-яё]+|[a-z]+\d*|\d+(?:[.,]\d+)?")
+_MAX_VARIABLE_LENGTH = 2
+
+_stemmer = SnowballStemmer("russian")
+
+
+@cache
+def get_russian_stop_words() -> frozenset[str]:
+    if str(NLTK_DATA_PATH) not in nltk.data.path:
+        nltk.data.path.append(str(NLTK_DATA_PATH))
+    try:
+        return frozenset(stopwords.words("russian"))
+    except LookupError:
+        nltk.download("stopwords", download_dir=NLTK_DATA_PATH, quiet=True)
+        return frozenset(stopwords.words("russian"))
+
+
+@lru_cache(maxsize=2**16)
+def stem_token(token: str) -> str:
+    return _stemmer.stem(token)
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase text, mask numbers and variables, drop stop words and stem Russian words"""
+    stop_words = get_russian_stop_words()
+    normalized_tokens = []
+    for token in _TOKEN_PATTERN.findall(text.lower()):
+        if token[0].isdigit():
+            normalized_tokens.append(NUMBER_MASK)
+        elif token[0].isascii():  # latin token
+            if len(token) <= _MAX_VARIABLE_LENGTH or token[-1].isdigit():
+                normalized_tokens.append(VARIABLE_MASK)
+            else:
+                normalized_tokens.append(token)
+        elif token not in stop_words:
+            normalized_tokens.append(stem_token(token))
+    return " ".join(normalized_tokens)
+
+
+def _get_text_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+class NormalizedTextCache:
+    """Per problem cache of normalize_text output, persisted between runs as a json file"""
+
+    def __init__(self, path: Path = NORMALIZED_TEXTS_CACHE_PATH) -> None:
+        self._path = path
+        self._entries: dict[str, list[str]] = {}  # problem_id -> [text_hash, normalized_text]
+        self._changed = False
+        if path.exists():
+            with open(path, encoding="utf-8") as file:
+                data = json.load(file)
+            if data.get("version") == NORMALIZATION_VERSION:
+                self._entries = data["entries"]
+
+    def get(self, problem_id: str, text: str) -> str:
+        text_hash = _get_text_hash(text)
+        entry = self._entries.get(problem_id)
+        if entry is not None and entry[0] == text_hash:
+            return entry[1]
+        normalized_text = normalize_text(text)
+        self._entries[problem_id] = [text_hash, normalized_text]
+        self._changed = True
+        return normalized_text
+
+    def save(self) -> None:
+        if not self._changed:
+            return
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(
+                {"version": NORMALIZATION_VERSION, "entries": self._entries},
+                file,
+                ensure_ascii=False,
+            )
+        tmp_path.replace(self._path)
+        self._changed = False
+
+
+def get_normalized_texts(
+    problem_ids: Iterable[str], texts: Iterable[str], cache: NormalizedTextCache | None = None
+) -> list[str]:
+    """Return normalized texts of problems, reusing the ones cached by previous runs"""
+    if cache is None:
+        cache = NormalizedTextCache()
+    normalized_texts = [
+        cache.get(problem_id, text) for problem_id, text in zip(problem_ids, texts, strict=True)
+    ]
+    cache.save()
+    return normalized_texts
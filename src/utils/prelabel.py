@@ -0,0 +1,63 @@
+import pandas as pd
+
+from ..database.methods import get_unlabelled_problems_themes, set_exam_numbers
+from ..misc import profiled
+from ..specifiers import BaseSpecifier, informatics_specifier_2024
+
+
+def get_candidate_exam_numbers(
+    themes: list[str], specifier: BaseSpecifier = informatics_specifier_2024
+) -> frozenset[int]:
+    theme_to_exam_numbers = specifier.theme_to_exam_numbers
+    return frozenset().union(*(theme_to_exam_numbers.get(theme, ()) for theme in themes))
+
+
+@profiled
+async def prelabel_problems(
+    specifier: BaseSpecifier = informatics_specifier_2024,
+    dry_run: bool = False,
+    problem_ids: list[str] | None = None,
+) -> pd.DataFrame:
+    """
+    Sets exam numbers of unlabelled problems whose themes resolve to a single exam number.
+
+    Args:
+        - specifier: Subject specifier, its theme to exam numbers index is used
+        - dry_run: Only report what would be labelled, without writing to the database
+        - problem_ids: Only label these problems, e.g. the ones changed by the last crawl
+
+    Returns:
+        DataFrame of ambiguous problems left for clustering, with "problem_id", "themes"
+        and "candidate_exam_numbers" columns
+    """
+    problems_df = await get_unlabelled_problems_themes(
+        gia_type=specifier.gia_type, subject_name=specifier.subject_name
+    )
+    if problem_ids is not None:
+        problems_df = problems_df[problems_df["problem_id"].isin(problem_ids)].reset_index(
+            drop=True
+        )
+    problems_df["themes"] = problems_df["themes"].str.split(",")
+    problems_df["candidate_exam_numbers"] = [
+        sorted(get_candidate_exam_numbers(themes, specifier)) for themes in problems_df["themes"]
+    ]
+    # .str accessors fail on an empty frame, e.g. when none of problem_ids is unlabelled
+    is_unambiguous = problems_df["candidate_exam_numbers"].map(len) == 1
+    exam_numbers = {
+        problem_id: candidate_exam_numbers[0]
+        for problem_id, candidate_exam_numbers in zip(
+            problems_df.loc[is_unambiguous, "problem_id"],
+            problems_df.loc[is_unambiguous, "candidate_exam_numbers"],
+            strict=True,
+        )
+    }
+
+    if dry_run:
+        print(f"{len(exam_numbers)} problems can be labelled by their themes.")
+    else:
+        updated_rows_count = await set_exam_numbers(exam_numbers)
+        for exam_number, problems_count in sorted(updated_rows_count.items()):
+            print(f'Set "{exam_number}" exam number to {problems_count} problems.')
+    ambiguous_df = problems_df.loc[~is_unambiguous].reset_index(drop=True)
+    print(f"{len(ambiguous_df)} problems have ambiguous themes and need clustering.")
+    return ambiguous_df
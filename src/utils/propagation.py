@@ -0,0 +1,175 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from ..database.methods import get_all_problems_with_details, replace_exam_number_proposals
+from ..database.models import register_models
+from ..misc import profiled, section
+from .similar import get_nearest_neighbours, get_problem_vectors
+
+
+def get_knn_graph(
+    neighbours: np.ndarray, similarities: np.ndarray, min_similarity: float = 0.0
+) -> sparse.csr_matrix:
+    """
+    Builds a symmetric sparse graph of problems, where every problem is connected with its
+    nearest neighbours, and normalizes it as D^-1/2 W D^-1/2.
+
+    Args:
+        - neighbours: Neighbours indices of every problem, from get_nearest_neighbours
+        - similarities: Their cosine similarities
+        - min_similarity: Neighbours that are less similar aren't connected
+    """
+    problems_count, n_neighbours = neighbours.shape
+    similarities = np.where(similarities >= min_similarity, similarities, 0).astype(np.float32)
+    weights = sparse.csr_matrix(
+        (
+            similarities.ravel(),
+            (np.repeat(np.arange(problems_count), n_neighbours), neighbours.ravel()),
+        ),
+        shape=(problems_count, problems_count),
+    )
+    weights = weights.maximum(weights.T)
+    weights.eliminate_zeros()
+    degrees = np.asarray(weights.sum(axis=1)).ravel()
+    inverse_sqrt_degrees = sparse.diags(
+        np.divide(1, np.sqrt(degrees), out=np.zeros_like(degrees), where=degrees > 0)
+    )
+    return (inverse_sqrt_degrees @ weights @ inverse_sqrt_degrees).tocsr()
+
+
+def spread_labels(
+    graph: sparse.csr_matrix,
+    labels: np.ndarray,
+    alpha: float = 0.9,
+    max_iter: int = 50,
+    tol: float = 1e-4,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Spreads labels over the normalized graph with F = alpha * S @ F + (1 - alpha) * Y
+    (Zhou et al., "Learning with local and global consistency").
+
+    Scores of larger classes spread further and would outweigh the others everywhere, so
+    before choosing the most probable class, scores of every class are divided by its total
+    mass over unlabelled vertices (class mass normalization with equal class weights,
+    Zhu et al., 2003). Weighting classes by their frequency among labelled vertices would
+    still give the largest class almost every vertex of a weakly clustered subject.
+
+    Args:
+        - graph: Normalized graph from get_knn_graph
+        - labels: Class index of every vertex, -1 for unlabelled ones
+        - alpha: Part of the label mass a vertex gets from its neighbours on every iteration
+        - max_iter: Maximum number of iterations
+        - tol: Iterations stop when no label score changes by more than tol
+
+    Returns:
+        Arrays of the most probable class of every vertex and its probability, -1 and 0
+        for vertices not connected to any labelled one
+    """
+    classes_count = labels.max() + 1
+    is_labelled = labels >= 0
+    initial_scores = np.zeros((len(labels), classes_count), dtype=np.float32)
+    initial_scores[is_labelled, labels[is_labelled]] = 1
+    scores = initial_scores
+    for _ in range(max_iter):
+        next_scores = alpha * (graph @ scores) + (1 - alpha) * initial_scores
+        converged = np.abs(next_scores - scores).max() < tol
+        scores = next_scores
+        if converged:
+            break
+    # Labelled vertices keep most of their own label, so only unlabelled ones are counted
+    class_masses = scores[~is_labelled].sum(axis=0)
+    scores = scores * np.divide(
+        1, class_masses, out=np.zeros_like(class_masses), where=class_masses > 0
+    )
+    scores_sum = scores.sum(axis=1)
+    has_scores = scores_sum > 0
+    predicted_labels = np.where(has_scores, scores.argmax(axis=1), -1)
+    confidences = np.divide(
+        scores.max(axis=1), scores_sum, out=np.zeros_like(scores_sum), where=has_scores
+    )
+    return predicted_labels, confidences
+
+
+@profiled
+async def propagate_exam_numbers(
+    n_neighbours: int = 10,
+    min_similarity: float = 0.1,
+    alpha: float = 0.9,
+    n_components: int | None = None,
+) -> pd.DataFrame:
+    """
+    Proposes exam numbers of unlabelled problems from exam numbers of similar problems.
+
+    Problems of every subject are connected with their nearest TF-IDF neighbours, and exam
+    numbers, outdated (negative) ones included, are spread over the graph. Proposals are
+    written to exam_number_proposals table, replacing the previous ones, and are reviewed
+    with get_exam_number_proposals and accepted with accept_exam_number_proposals.
+
+    Args:
+        - n_neighbours: Number of nearest neighbours every problem is connected with
+        - min_similarity: Minimum cosine similarity of connected problems
+        - alpha: Part of the label mass a problem gets from its neighbours on every iteration
+        - n_components: Reduce TF-IDF vectors with TruncatedSVD to this number of dimensions
+
+    Returns:
+        DataFrame of proposals with "problem_id", "exam_number" and "confidence" columns
+    """
+    await register_models()
+    with section("db"):
+        problems_df = (
+            (await get_all_problems_with_details())
+            .drop_duplicates("problem_id")
+            .reset_index(drop=True)
+        )
+    subject_proposals_dfs = []
+    # Exam numbers of different subjects mean different things, so they don't spread between
+    for (gia_type, subject_name), subject_df in problems_df.groupby(
+        ["gia_type", "subject_name"], sort=False
+    ):
+        subject_df = subject_df.reset_index(drop=True)
+        is_labelled = subject_df["exam_number"].notna().to_numpy()
+        if is_labelled.all() or not is_labelled.any() or len(subject_df) < 2:
+            continue
+        with section("vectorize"):
+            try:
+                vectors = get_problem_vectors(subject_df, n_components=n_components)
+            except ValueError as e:  # e.g. no term occurs in two problems of a small subject
+                print(f"{gia_type} {subject_name}: skipped, {e}")
+                continue
+        with section("neighbours"):
+            neighbours, similarities = get_nearest_neighbours(vectors, n_neighbours)
+        with section("propagate"):
+            exam_numbers, labels = np.unique(
+                subject_df.loc[is_labelled, "exam_number"].astype(int), return_inverse=True
+            )
+            problem_labels = np.full(len(subject_df), -1)
+            problem_labels[is_labelled] = labels
+            predicted_labels, confidences = spread_labels(
+                get_knn_graph(neighbours, similarities, min_similarity),
+                problem_labels,
+                alpha=alpha,
+            )
+        is_proposed = ~is_labelled & (predicted_labels >= 0)
+        subject_proposals_dfs.append(
+            pd.DataFrame(
+                {
+                    "problem_id": subject_df.loc[is_proposed, "problem_id"],
+                    "exam_number": exam_numbers[predicted_labels[is_proposed]],
+                    "confidence": confidences[is_proposed].astype(float),
+                }
+            )
+        )
+        print(
+            f"{gia_type} {subject_name}: {is_proposed.sum()} of {(~is_labelled).sum()} "
+            f"unlabelled problems got proposals."
+        )
+    proposals_df = (
+        pd.concat(subject_proposals_dfs, ignore_index=True)
+        if subject_proposals_dfs
+        else pd.DataFrame(columns=["problem_id", "exam_number", "confidence"])
+    )
+    with section("db_save"):
+        await replace_exam_number_proposals(problems_df["problem_id"].tolist(), proposals_df)
+    print(f"Stored {len(proposals_df)} exam number proposals.")
+    return proposals_df
@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+from ..database.methods import get_all_problems_with_details, replace_problem_neighbours
+from ..database.models import register_models
+from ..misc import profiled, section
+from .__main__ import get_problem_text
+from .normalization import get_normalized_texts
+
+
+def get_problem_vectors(
+    problems_df: pd.DataFrame, n_components: int | None = None
+) -> sparse.csr_matrix | np.ndarray:
+    """
+    Vectorizes problems with TF-IDF of their normalized texts.
+
+    Args:
+        - problems_df: DataFrame with "problem_id" and "condition_html" columns
+        - n_components: Reduce vectors to this number of dimensions with TruncatedSVD
+
+    Returns:
+        L2-normalized vectors, so their dot product is cosine similarity
+    """
+    condition_texts = [
+        get_problem_text(html, parser="selectolax") for html in problems_df["condition_html"]
+    ]
+    normalized_texts = get_normalized_texts(problems_df["problem_id"], condition_texts)
+    tfidf_vectorizer = TfidfVectorizer(
+        min_df=2, lowercase=False, tokenizer=str.split, token_pattern=None, dtype=np.float32
+    )
+    vectors = tfidf_vectorizer.fit_transform(normalized_texts)
+    if n_components is not None:
+        n_components = min(n_components, vectors.shape[1] - 1)
+        vectors = normalize(TruncatedSVD(n_components, random_state=42).fit_transform(vectors))
+    return vectors
+
+
+def get_nearest_neighbours(
+    vectors: sparse.csr_matrix | np.ndarray, n_neighbours: int, chunk_size: int = 1024
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the most cosine similar vectors of every L2-normalized vector, except itself.
+
+    Similarities are computed for chunk_size vectors at a time, so memory stays
+    within chunk_size * len(vectors) floats.
+
+    Returns:
+        Arrays of neighbours indices and similarities, each of shape (len(vectors), n_neighbours),
+        ordered from the most similar neighbour
+    """
+    vectors_count = vectors.shape[0]
+    n_neighbours = min(n_neighbours, vectors_count - 1)
+    neighbours = np.empty((vectors_count, n_neighbours), dtype=np.int64)
+    similarities = np.empty((vectors_count, n_neighbours), dtype=np.float32)
+    for start in range(0, vectors_count, chunk_size):
+        end = min(start + chunk_size, vectors_count)
+        chunk_similarities = vectors[start:end] @ vectors.T
+        if sparse.issparse(chunk_similarities):
+            chunk_similarities = chunk_similarities.toarray()
+        rows = np.arange(end - start)
+        chunk_similarities[rows, rows + start] = -np.inf  # exclude the vector itself
+        chunk_neighbours = np.argpartition(-chunk_similarities, n_neighbours - 1, axis=1)[
+            :, :n_neighbours
+        ]
+        chunk_neighbours_similarities = np.take_along_axis(
+            chunk_similarities, chunk_neighbours, axis=1
+        )
+        order = np.argsort(-chunk_neighbours_similarities, axis=1)
+        neighbours[start:end] = np.take_along_axis(chunk_neighbours, order, axis=1)
+        similarities[start:end] = np.take_along_axis(chunk_neighbours_similarities, order, axis=1)
+    return neighbours, similarities
+
+
+@profiled
+async def build_similar_problems_index(
+    n_neighbours: int = 10, n_components: int | None = None
+) -> int:
+    """
+    Precomputes the most similar problems of every problem in the bank for /similar endpoint.
+
+    Args:
+        - n_neighbours: Number of similar problems stored for every problem
+        - n_components: Reduce TF-IDF vectors with TruncatedSVD to this number of dimensions
+
+    Problems without any term of the vocabulary have zero vectors, whose similarities
+    are meaningless, so they get no neighbours and aren't neighbours of others.
+
+    Returns:
+        Number of stored neighbour rows
+    """
+    await register_models()
+    with section("db"):
+        problems_df = (
+            (await get_all_problems_with_details())
+            .drop_duplicates("problem_id")
+            .reset_index(drop=True)
+        )
+    with section("vectorize"):
+        vectors = get_problem_vectors(problems_df, n_components=n_components)
+        has_terms = np.asarray(abs(vectors).sum(axis=1)).ravel() > 0
+        vectors = vectors[has_terms]
+    with section("neighbours"):
+        neighbours, similarities = get_nearest_neighbours(vectors, n_neighbours)
+    problem_ids = problems_df.loc[has_terms, "problem_id"].to_numpy()
+    with section("db_save"):
+        rows_count = await replace_problem_neighbours(
+            problem_ids=problem_ids.tolist(),
+            neighbour_problem_ids=problem_ids[neighbours].tolist(),
+            similarities=similarities.tolist(),
+        )
+    print(
+        f"Stored {n_neighbours} similar problems of {len(problem_ids)} problems, "
+        f"{len(problems_df) - len(problem_ids)} problems have no terms."
+    )
+    return rows_count
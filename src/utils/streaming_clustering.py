@@ -0,0 +1,154 @@
+import pickle
+import tempfile
+import time
+from collections.abc import AsyncIterator, Iterator
+from typing import IO
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+
+from ..database.methods import iter_problems_chunks
+from ..misc import profiled
+from .__main__ import get_problem_text
+from .normalization import normalize_text
+
+
+async def _iter_vectors_chunks(
+    vectorizer: HashingVectorizer, chunk_size: int, gia_type: str | None, subject_name: str | None
+) -> AsyncIterator[tuple[list[str], sparse.csr_matrix]]:
+    async for chunk in iter_problems_chunks(chunk_size, gia_type, subject_name):
+        yield (
+            [problem.problem_id for problem in chunk],
+            vectorizer.transform(
+                [
+                    normalize_text(get_problem_text(problem.condition_html, parser="selectolax"))
+                    for problem in chunk
+                ]
+            ),
+        )
+
+
+def _iter_spilled_chunks(file: IO[bytes]) -> Iterator[tuple[list[str], sparse.csr_matrix]]:
+    """Read back chunks pickled to the file one after another"""
+    file.seek(0)
+    while True:
+        try:
+            # The file is a temporary one written by this process only
+            yield pickle.load(file)  # noqa: S301
+        except EOFError:
+            return
+
+
+def _print_throughput(stage: str, problems_count: int, start_time: float) -> None:
+    elapsed_time = time.perf_counter() - start_time
+    print(
+        f"{stage}: {problems_count} problems in {elapsed_time:.2f} s, "
+        f"{problems_count / elapsed_time if elapsed_time else 0:.0f} problems/s"
+    )
+
+
+@profiled
+async def stream_clusterize_problems(
+    n_clusters: int,
+    gia_type: str | None = None,
+    subject_name: str | None = None,
+    chunk_size: int = 2000,
+    n_features: int = 2**18,
+    n_components: int = 100,
+    svd_sample_size: int = 10000,
+) -> pd.DataFrame:
+    """
+    Clusters the whole bank (or one gia type and subject of it) with bounded memory.
+
+    Problems are read from the database by chunks, normalized and vectorized with stateless
+    HashingVectorizer once, in the first pass. Their sparse vectors are spilled chunk by
+    chunk to a temporary file, which the next passes read instead of the database.
+    TruncatedSVD is fitted on a uniform random sample of svd_sample_size problems drawn in
+    the first pass, MiniBatchKMeans is fitted with partial_fit chunk by chunk in the second
+    one, then every problem gets its cluster in the last pass. Only one chunk of problems
+    and the sample are kept in memory at once.
+
+    Args:
+        - n_clusters: Number of clusters
+        - gia_type: Cluster problems of this gia type only, if set
+        - subject_name: Cluster problems of this subject only, if set
+        - chunk_size: Number of problems read and vectorized at once
+        - n_features: Number of hashed features
+        - n_components: Number of dimensions vectors are reduced to
+        - svd_sample_size: Number of problems TruncatedSVD is fitted on
+
+    Returns:
+        DataFrame with "problem_id" and "cluster_label" columns
+    """
+    vectorizer = HashingVectorizer(
+        n_features=n_features,
+        alternate_sign=False,
+        lowercase=False,
+        tokenizer=str.split,
+        token_pattern=None,
+        dtype=np.float32,
+    )
+
+    with tempfile.TemporaryFile() as vectors_file:
+        # Fitting dimensionality reduction on a reservoir sample of problems
+        t1 = time.perf_counter()
+        rng = np.random.default_rng(42)
+        sample_vectors: list[sparse.csr_matrix] = []
+        problems_count = 0
+        async for problem_ids_chunk, vectors in _iter_vectors_chunks(
+            vectorizer, chunk_size, gia_type, subject_name
+        ):
+            pickle.dump((problem_ids_chunk, vectors), vectors_file)
+            # Row number n replaces a random sampled row with probability svd_sample_size / (n + 1)
+            sample_positions = rng.integers(
+                0, np.arange(problems_count, problems_count + vectors.shape[0]) + 1
+            )
+            for i, sample_position in enumerate(sample_positions):
+                if len(sample_vectors) < svd_sample_size:
+                    sample_vectors.append(vectors[i])
+                elif sample_position < svd_sample_size:
+                    sample_vectors[sample_position] = vectors[i]
+            problems_count += vectors.shape[0]
+        if problems_count < n_clusters:
+            raise ValueError(f"Not enough problems ({problems_count}) for {n_clusters} clusters")
+        svd = TruncatedSVD(
+            n_components=min(n_components, len(sample_vectors) - 1, n_features - 1),
+            random_state=42,
+        )
+        svd.fit(sparse.vstack(sample_vectors))
+        del sample_vectors
+        _print_throughput("SVD fitting", problems_count, t1)
+
+        # Fitting clusters chunk by chunk. Chunks smaller than n_clusters are merged with next ones
+        t1 = time.perf_counter()
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=42, n_init=3)
+        pending_vectors: list[np.ndarray] = []
+        for _, vectors in _iter_spilled_chunks(vectors_file):
+            pending_vectors.append(normalize(svd.transform(vectors)))
+            if sum(len(reduced_vectors) for reduced_vectors in pending_vectors) >= n_clusters:
+                kmeans.partial_fit(np.vstack(pending_vectors))
+                pending_vectors = []
+        if pending_vectors:
+            kmeans.partial_fit(np.vstack(pending_vectors))
+        _print_throughput("Clusters fitting", problems_count, t1)
+
+        # Assigning clusters
+        t1 = time.perf_counter()
+        problem_ids: list[str] = []
+        cluster_labels_chunks = []
+        for problem_ids_chunk, vectors in _iter_spilled_chunks(vectors_file):
+            problem_ids.extend(problem_ids_chunk)
+            cluster_labels_chunks.append(kmeans.predict(normalize(svd.transform(vectors))))
+        _print_throughput("Clusters assignment", len(problem_ids), t1)
+
+    return pd.DataFrame(
+        {
+            "problem_id": problem_ids,
+            "cluster_label": np.concatenate(cluster_labels_chunks),
+        }
+    )
@@ -1,12 +1,18 @@
 import asyncio
+import os
+import time
 from pathlib import Path
 
-from flask import Flask, jsonify, request, send_from_directory
+import requests
+from flask import Flask, Response, abort, g, jsonify, request, send_file, send_from_directory
 from jinja2 import Environment, FileSystemLoader
-from selectolax.parser import HTMLParser
 
-from ..database.methods import get_problems_by_exam_number
-from ..misc import PathControl
+from ..database.methods import get_facet_counts, get_similar_problems
+from ..database.models import ProblemStatusEnum
+from ..misc import PathControl, section
+from ..misc.profiling import start_timings, stop_timings
+from .files import FileCache, get_file_mimetype
+from .snapshot import get_snapshot
 
 env = Environment(
     loader=FileSystemLoader(PathControl.get(str(Path("web_ui") / "templates"))),
@@ -17,32 +23,147 @@ env = Environment(
 
 main_page_template = env.get_template("index.html")
 app = Flask(__name__)
+file_cache = FileCache()
+# A file behind /files/<hash> never changes, as the hash is derived from its url
+FILES_MAX_AGE = 365 * 24 * 60 * 60
+DEFAULT_PROBLEMS_LIMIT = 100
+MAX_PROBLEMS_LIMIT = 1000
+# Development server reloads the snapshot itself, gunicorn master does it for its workers
+app.config["SNAPSHOT_RELOAD_IF_CHANGED"] = True
+# Log Server-Timing of every request in addition to sending it to the client
+app.config["LOG_SERVER_TIMING"] = os.environ.get("FIPIBANK_LOG_SERVER_TIMING", "") == "1"
 
 
-def remove_element_by_css_selector(html: str, css_selector: str) -> str:
-    tree = HTMLParser(html=html)
-    element = tree.css_first(css_selector)
-    if element:
-        element.decompose()
-    return str(tree.body.html)
+@app.before_request
+def start_request_timings():
+    g.timings_token = start_timings()
+    g.request_start_time = time.perf_counter()
+
+
+@app.after_request
+def add_server_timing_header(response: Response) -> Response:
+    if "timings_token" not in g:
+        return response
+    timings = stop_timings(g.pop("timings_token"))
+    timings["total"] = time.perf_counter() - g.request_start_time
+    server_timing = ", ".join(
+        f"{name};dur={seconds * 1000:.2f}" for name, seconds in timings.items()
+    )
+    response.headers["Server-Timing"] = server_timing
+    if app.config["LOG_SERVER_TIMING"]:
+        app.logger.info("%s %s Server-Timing: %s", request.method, request.path, server_timing)
+    return response
+
+
+@app.teardown_request
+def reset_request_timings(_exception: BaseException | None) -> None:
+    # after_request isn't called when a request fails with an unhandled exception
+    if "timings_token" in g:
+        stop_timings(g.pop("timings_token"))
 
 
 @app.route("/")
 def index():
-    return main_page_template.render()
+    with section("render"):
+        return main_page_template.render()
 
 
 @app.route("/get_problems", methods=["POST"])
 def get_problems():
     exam_number = int(request.json["exam_number"])
     print(f"{exam_number=}")
-    problems_data = asyncio.run(get_problems_by_exam_number(exam_number))
-    problem_htmls = [i.condition_html for i in problems_data]
+    with section("snapshot"):
+        snapshot = get_snapshot(reload_if_changed=app.config["SNAPSHOT_RELOAD_IF_CHANGED"])
+    return Response(snapshot.get_problems_json(exam_number), mimetype="application/json")
+
+
+@app.route("/facets")
+def facets():
+    """Numbers of problems by gia type, subject and facet values, e.g.
+    {"ege": {"Информатика и ИКТ": {"status": {"actual": 10}, "theme": {"2.1": 3}}}}
+    """
+    with section("db"):
+        facet_counts = asyncio.run(
+            get_facet_counts(
+                gia_type=request.args.get("gia_type"), subject_name=request.args.get("subject")
+            )
+        )
+    result: dict[str, dict[str, dict[str, dict[str, int]]]] = {}
+    for i in facet_counts:
+        subject_facets = result.setdefault(i.gia_type, {}).setdefault(i.subject_name, {})
+        subject_facets.setdefault(i.facet, {})[i.value] = i.problems_count
+    with section("serialize"):
+        return jsonify(result)
+
+
+def _get_limit_arg(default: int | None, maximum: int | None = None) -> int | None:
+    limit = request.args.get("limit", default, type=int)
+    if limit is None:
+        return None
+    if limit < 1:
+        abort(400, "limit should be positive")
+    return limit if maximum is None else min(limit, maximum)
+
+
+@app.route("/problems")
+def filtered_problems():
+    status = request.args.get("status")
+    if status is not None and status not in ProblemStatusEnum.__members__:
+        abort(400, f"status should be one of {', '.join(ProblemStatusEnum.__members__)}")
+    limit = _get_limit_arg(DEFAULT_PROBLEMS_LIMIT, MAX_PROBLEMS_LIMIT)
+    offset = request.args.get("offset", 0, type=int)
+    if offset < 0:
+        abort(400, "offset should be non-negative")
+    with section("snapshot"):
+        snapshot = get_snapshot(reload_if_changed=app.config["SNAPSHOT_RELOAD_IF_CHANGED"])
+        problems_json = snapshot.get_filtered_problems_json(
+            limit=limit,
+            offset=offset,
+            gia_type=request.args.get("gia_type"),
+            subject_name=request.args.get("subject"),
+            codifier_id=request.args.get("theme"),
+            exam_number=request.args.get("exam_number", type=int),
+            status=ProblemStatusEnum(status) if status is not None else None,
+        )
+    return Response(problems_json, mimetype="application/json")
+
+
+@app.route("/similar/<problem_id>")
+def similar_problems(problem_id: str):
+    limit = _get_limit_arg(None)
+    with section("db"):
+        similar_problems_data = asyncio.run(get_similar_problems(problem_id, limit=limit))
+    with section("serialize"):
+        return jsonify(
+            [
+                {"problem_id": i.problem_id, "url": i.url, "similarity": round(i.similarity, 4)}
+                for i in similar_problems_data
+            ]
+        )
+
 
-    problems = [
-        remove_element_by_css_selector(i, "table > tbody > tr:nth-child(2)") for i in problem_htmls
-    ]  # removing the response input field
-    return jsonify(problems)
+@app.route("/files/<file_hash>")
+def problem_file(file_hash: str):
+    snapshot = get_snapshot(reload_if_changed=app.config["SNAPSHOT_RELOAD_IF_CHANGED"])
+    file_url = snapshot.file_urls.get(file_hash)
+    if file_url is None:
+        abort(404)
+    with section("file"):
+        try:
+            file_path = file_cache.get(file_url)
+        except requests.RequestException:
+            app.logger.exception("Failed to download %s", file_url)
+            abort(502)
+    # Modification time of a cached file is its last use time, so it can't tag the file
+    response = send_file(
+        file_path,
+        mimetype=get_file_mimetype(file_path),
+        max_age=FILES_MAX_AGE,
+        conditional=True,
+        etag=file_hash,
+    )
+    response.cache_control.immutable = True
+    return response
 
 
 @app.route("/robots.txt")
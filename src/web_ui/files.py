@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+from pathlib import Path
+
+import requests
+import urllib3
+from selectolax.parser import HTMLParser, Node
+
+from ..misc import PathControl
+
+FILES_CACHE_PATH = PathControl.get(".cache/files")
+FILES_CACHE_MAX_SIZE = int(os.environ.get("FIPIBANK_FILES_CACHE_MAX_SIZE", 512 * 2**20))
+# fipi.ru has served an incomplete certificate chain, set to 0 to download files without
+# verifying it
+FILES_VERIFY_TLS = os.environ.get("FIPIBANK_FILES_VERIFY_TLS", "1") != "0"
+FILES_URL_PREFIX = "/files/"
+
+# Problem pages show their images with scripts like ShowPictureQ('../../docs/<subject>/img.png')
+_IMAGE_SCRIPT_URL_PATTERN = re.compile(r"ShowPictureQ\w{0,3}\('(.+?)'")
+_DOWNLOAD_TIMEOUT = 30
+
+
+def get_file_hash(file_url: str) -> str:
+    return hashlib.blake2b(file_url.encode(), digest_size=16).hexdigest()
+
+
+def _find_file_url(relative_url: str, file_urls: list[str]) -> str | None:
+    path = relative_url.removeprefix("../../").lstrip("/")
+    return next((file_url for file_url in file_urls if file_url.endswith(path)), None)
+
+
+def _create_lazy_image(file_url: str) -> Node:
+    return HTMLParser(
+        f'<img src="{FILES_URL_PREFIX}{get_file_hash(file_url)}" loading="lazy" decoding="async">'
+    ).css_first("img")
+
+
+def rewrite_file_urls(tree: HTMLParser, file_urls: list[str]) -> None:
+    """Point images of the problem to the local /files/ route and make them load lazily.
+
+    Image scripts, which don't run when problems are inserted to the page, are replaced with
+    img tags, one for every image of the script. Only files known to belong to the problem are rewritten, others are left as is.
+    """
+    if not file_urls:
+        return
+    for script in tree.css("script"):
+        script_file_urls = [
+            file_url
+            for image_url in _IMAGE_SCRIPT_URL_PATTERN.findall(script.text())
+            if (file_url := _find_file_url(image_url, file_urls)) is not None
+        ]
+        if not script_file_urls:
+            continue
+        for file_url in script_file_urls:
+            script.insert_before(_create_lazy_image(file_url))
+        script.decompose()
+    for image in tree.css("img"):
+        source = image.attributes.get("src")
+        if not source or source.startswith(FILES_URL_PREFIX):
+            continue
+        file_url = _find_file_url(source, file_urls)
+        if file_url is not None:
+            image.attrs["src"] = f"{FILES_URL_PREFIX}{get_file_hash(file_url)}"
+            image.attrs["loading"] = "lazy"
+
+
+class FileCache:
+    """Problem files downloaded from fipi.ru and kept on disk.
+
+    When the total size of the files exceeds max_size, the least recently used ones
+    are removed. File modification time is the time of its last use.
+    """
+
+    def __init__(
+        self,
+        path: Path = FILES_CACHE_PATH,
+        max_size: int = FILES_CACHE_MAX_SIZE,
+        verify_tls: bool = FILES_VERIFY_TLS,
+    ) -> None:
+        self._path = path
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        self._session.verify = verify_tls
+        if not verify_tls:
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    def get(self, file_url: str) -> Path:
+        """Return path of the cached file, downloading it if it isn't cached.
+
+        Raises:
+            requests.RequestException: If the file isn't cached and can't be downloaded
+        """
+        file_path = self._path / f"{get_file_hash(file_url)}{Path(file_url).suffix}"
+        try:
+            os.utime(file_path)
+        except FileNotFoundError:
+            self._download(file_url, file_path)
+        return file_path
+
+    def _download(self, file_url: str, file_path: Path) -> None:
+        response = self._session.get(file_url, timeout=_DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+        self._path.mkdir(parents=True, exist_ok=True)
+        # Other processes may read or download the same file, so it appears at once
+        tmp_path = file_path.with_name(
+            f"{file_path.name}.{os.getpid()}-{threading.get_ident()}.tmp"
+        )
+        tmp_path.write_bytes(response.content)
+        tmp_path.replace(file_path)
+        self._evict()
+
+    def _evict(self) -> None:
+        with self._lock:
+            files = []
+            total_size = 0
+            for file_path in self._path.iterdir():
+                if file_path.suffix == ".tmp":  # being downloaded
+                    continue
+                try:
+                    stat = file_path.stat()
+                except FileNotFoundError:  # removed by another process
+                    continue
+                files.append((stat.st_mtime_ns, stat.st_size, file_path))
+                total_size += stat.st_size
+            files.sort()
+            for _, size, file_path in files:
+                if total_size <= self._max_size:
+                    break
+                file_path.unlink(missing_ok=True)
+                total_size -= size
+
+
+def get_file_mimetype(file_path: Path) -> str:
+    return mimetypes.guess_type(file_path.name)[0] or "application/octet-stream"
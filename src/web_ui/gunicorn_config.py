@@ -0,0 +1,57 @@
+"""Production serving: gunicorn -c src/web_ui/gunicorn_config.py src.web_ui.app:app
+
+The problem snapshot is loaded once in the master process before workers are forked,
+so all workers share its memory. When the database file changes, the master loads
+a new snapshot and gracefully replaces the workers.
+"""
+
+import gc
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+from src.database import models
+from src.web_ui.snapshot import get_database_version, get_snapshot, load_snapshot
+
+bind = os.environ.get("FIPIBANK_BIND", "127.0.0.1:3636")
+workers = int(os.environ.get("FIPIBANK_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+preload_app = True
+
+SNAPSHOT_CHECK_INTERVAL = float(os.environ.get("FIPIBANK_SNAPSHOT_CHECK_INTERVAL", 10))
+
+
+def _load_shared_snapshot() -> None:
+    load_snapshot()
+    # Keep the garbage collector from touching, and so copying, the snapshot pages in workers
+    gc.collect()
+    gc.freeze()
+
+
+def _watch_database(master_pid: int) -> None:
+    while True:
+        time.sleep(SNAPSHOT_CHECK_INTERVAL)
+        try:
+            changed = get_snapshot().version != get_database_version()
+        except FileNotFoundError:  # database is being swapped
+            continue
+        if changed:
+            os.kill(master_pid, signal.SIGHUP)
+
+
+def when_ready(server) -> None:
+    server.app.wsgi().config["SNAPSHOT_RELOAD_IF_CHANGED"] = False
+    _load_shared_snapshot()
+    server.log.info("Loaded problems snapshot %s", get_snapshot().version)
+    threading.Thread(target=_watch_database, args=(os.getpid(),), daemon=True).start()
+
+
+def on_reload(server) -> None:
+    _load_shared_snapshot()
+    server.log.info("Reloaded problems snapshot %s", get_snapshot().version)
+
+
+def post_fork(server, worker) -> None:
+    # Database connections opened by the master must not be used by its children
+    models.engine.sync_engine.dispose(close=False)
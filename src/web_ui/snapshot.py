@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import asyncio
+import json
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any
+
+import numpy as np
+import pandas as pd
+from selectolax.parser import HTMLParser
+
+from ..database import models
+from ..database.methods import get_problems_file_urls, stream_all_problems_with_details
+from ..database.models import DATABASE_PATH, ProblemStatusEnum
+from ..misc import section
+from .files import get_file_hash, rewrite_file_urls
+
+_snapshot: ProblemSnapshot | None = None
+
+
+def _remove_element_by_css_selector(tree: HTMLParser, css_selector: str) -> None:
+    element = tree.css_first(css_selector)
+    if element:
+        element.decompose()
+
+
+def remove_element_by_css_selector(html: str, css_selector: str) -> str:
+    tree = HTMLParser(html=html)
+    _remove_element_by_css_selector(tree, css_selector)
+    return str(tree.body.html)
+
+
+def sanitize_problem_html(html: str, file_urls: list[str] | None = None) -> str:
+    tree = HTMLParser(html=html)
+    # removing the response input field
+    _remove_element_by_css_selector(tree, "table > tbody > tr:nth-child(2)")
+    if file_urls:
+        rewrite_file_urls(tree, file_urls)
+    return str(tree.body.html)
+
+
+def get_database_version() -> tuple[int, int, int]:
+    """Identify database file contents by inode (changes on swap), mtime and size"""
+    stat = DATABASE_PATH.stat()
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _join_json_list(items: list[bytes]) -> bytes:
+    return b"[" + b",".join(items) + b"]"
+
+
+@dataclass(frozen=True)
+class ProblemSnapshot:
+    """Immutable, ready to serve problems of the database in database order.
+
+    Problems are stored in two blobs: json strings of their sanitized htmls and json
+    objects of their other fields lacking the html and the closing brace. Problems of every
+    gia type, subject and theme are numpy arrays of problem indices. So a fork of the process
+    serving the snapshot shares its memory instead of copying it on reference counting.
+    Images of the problems point to /files/<hash>, file_urls maps hashes of all files
+    of the bank to their urls.
+    """
+
+    version: tuple[int, int, int]
+    htmls_json: bytes
+    htmls_offsets: np.ndarray
+    fields_json: bytes
+    fields_offsets: np.ndarray
+    exam_numbers: np.ndarray  # 0 for unlabelled problems
+    # Keys are ("gia_type", name), ("subject", name) and ("theme", codifier id)
+    facet_problem_indices: dict[tuple[str, str], np.ndarray]
+    file_urls: dict[str, str]
+
+    @classmethod
+    async def load(cls) -> ProblemSnapshot:
+        version = get_database_version()
+        with section("db"):
+            problem_file_urls: defaultdict[str, list[str]] = defaultdict(list)
+            for problem_file in await get_problems_file_urls():
+                problem_file_urls[problem_file.problem_id].append(problem_file.file_url)
+        htmls_json = bytearray()
+        htmls_offsets = [0]
+        fields_json = bytearray()
+        fields_offsets = [0]
+        exam_numbers: list[int] = []
+        facet_problem_indices: defaultdict[tuple[str, str], list[int]] = defaultdict(list)
+        problem_id = None
+        # A problem of several subjects comes in several consecutive rows
+        async for problems_df in stream_all_problems_with_details():
+            for i in problems_df.itertuples(index=False):
+                if i.problem_id != problem_id:
+                    problem_id = i.problem_id
+                    exam_number = None if pd.isna(i.exam_number) else int(i.exam_number)
+                    with section("sanitize"):
+                        html = sanitize_problem_html(
+                            i.condition_html, problem_file_urls.get(problem_id)
+                        )
+                    with section("serialize"):
+                        htmls_json += json.dumps(html, ensure_ascii=False).encode()
+                        fields_json += (
+                            json.dumps(
+                                {
+                                    "problem_id": problem_id,
+                                    "exam_number": exam_number,
+                                    "url": i.url,
+                                },
+                                ensure_ascii=False,
+                            ).encode()[:-1]
+                            + b', "html": '
+                        )
+                    htmls_offsets.append(len(htmls_json))
+                    fields_offsets.append(len(fields_json))
+                    exam_numbers.append(exam_number or 0)
+                problem_index = len(exam_numbers) - 1
+                facet_problem_indices["gia_type", i.gia_type].append(problem_index)
+                facet_problem_indices["subject", i.subject_name].append(problem_index)
+                for codifier_id in (i.themes or "").split(","):
+                    if codifier_id:
+                        facet_problem_indices["theme", codifier_id].append(problem_index)
+        return cls(
+            version=version,
+            htmls_json=bytes(htmls_json),
+            htmls_offsets=np.array(htmls_offsets, dtype=np.int64),
+            fields_json=bytes(fields_json),
+            fields_offsets=np.array(fields_offsets, dtype=np.int64),
+            exam_numbers=np.array(exam_numbers, dtype=np.int32),
+            facet_problem_indices={
+                key: np.unique(np.array(indices, dtype=np.int32))
+                for key, indices in facet_problem_indices.items()
+            },
+            file_urls={
+                get_file_hash(file_url): file_url
+                for file_urls in problem_file_urls.values()
+                for file_url in file_urls
+            },
+        )
+
+    def _get_html_json(self, problem_index: int) -> bytes:
+        return self.htmls_json[
+            self.htmls_offsets[problem_index] : self.htmls_offsets[problem_index + 1]
+        ]
+
+    def _get_problem_json(self, problem_index: int) -> bytes:
+        fields_json = self.fields_json[
+            self.fields_offsets[problem_index] : self.fields_offsets[problem_index + 1]
+        ]
+        return fields_json + self._get_html_json(problem_index) + b"}"
+
+    def get_problems_json(self, exam_number: int) -> bytes:
+        """Return htmls of problems with given exam number, all outdated problems if it isn't
+        positive"""
+        if exam_number > 0:
+            problem_indices = np.flatnonzero(self.exam_numbers == exam_number)
+        else:
+            problem_indices = np.flatnonzero(self.exam_numbers < 0)
+        return _join_json_list([self._get_html_json(i) for i in problem_indices])
+
+    def find_problems(
+        self,
+        gia_type: str | None = None,
+        subject_name: str | None = None,
+        codifier_id: str | None = None,
+        exam_number: int | None = None,
+        status: ProblemStatusEnum | None = None,
+    ) -> np.ndarray:
+        """Return indices of problems matching all given filters, see get_filtered_problems"""
+        is_matching = np.ones(len(self.exam_numbers), dtype=bool)
+        for facet, value in (
+            ("gia_type", gia_type),
+            ("subject", subject_name),
+            ("theme", codifier_id),
+        ):
+            if value is not None:
+                is_facet_value = np.zeros_like(is_matching)
+                is_facet_value[self.facet_problem_indices.get((facet, value), [])] = True
+                is_matching &= is_facet_value
+        if exam_number is not None:
+            is_matching &= self.exam_numbers == exam_number
+        if status == ProblemStatusEnum.actual:
+            is_matching &= self.exam_numbers > 0
+        elif status == ProblemStatusEnum.outdated:
+            is_matching &= self.exam_numbers < 0
+        elif status == ProblemStatusEnum.unlabelled:
+            is_matching &= self.exam_numbers == 0
+        return np.flatnonzero(is_matching)
+
+    def get_filtered_problems_json(self, limit: int, offset: int = 0, **filters: Any) -> bytes:
+        """Return a page of problems matching filters of find_problems as a json list
+        of objects with problem_id, exam_number, url and html"""
+        problem_indices = self.find_problems(**filters)[offset : offset + limit]
+        return _join_json_list([self._get_problem_json(i) for i in problem_indices])
+
+
+async def _load_snapshot() -> ProblemSnapshot:
+    if _snapshot is not None and _snapshot.version[0] != get_database_version()[0]:
+        # The database file was swapped, pooled connections still read the previous one
+        await models.engine.dispose()
+    return await ProblemSnapshot.load()
+
+
+def load_snapshot() -> ProblemSnapshot:
+    global _snapshot
+    _snapshot = asyncio.run(_load_snapshot())
+    return _snapshot
+
+
+def get_snapshot(reload_if_changed: bool = False) -> ProblemSnapshot:
+    if _snapshot is None or (reload_if_changed and _snapshot.version != get_database_version()):
+        return load_snapshot()
+    return _snapshot
@@ -1,64 +1,127 @@
-// Функция для получения заданий по номеру экзамена
-async function fetchProblems(examNumber) {
-    if (examNumber != 0) {
-        const response = await fetch('/get_problems', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({ exam_number: examNumber })
-        });
-        return await response.json();
-    } else {
-        return [];
+const PAGE_SIZE = 100;
+const GIA_TYPE_NAMES = { oge: 'ОГЭ', ege: 'ЕГЭ' };
+const STATUS_NAMES = { actual: 'Актуальные', outdated: 'Устаревшие', unlabelled: 'Без типа' };
+
+// Количество задач по значениям фильтров: {giaType: {subject: {facet: {value: count}}}}
+let facets = {};
+let loadedProblemsCount = 0;
+
+const filterIds = ['giaType', 'subject', 'status', 'examNumber', 'theme'];
+const [giaTypeSelect, subjectSelect, statusSelect, examNumberSelect, themeSelect] =
+    filterIds.map(id => document.getElementById(id));
+
+// Заменяет варианты select-элемента, оставляя первый вариант ("Все ...") при keepFirst
+function setOptions(select, values, getLabel, keepFirst) {
+    const firstOption = keepFirst ? select.options[0] : null;
+    select.innerHTML = '';
+    if (firstOption) {
+        select.appendChild(firstOption);
     }
+    values.forEach(value => {
+        const option = document.createElement('option');
+        option.value = value;
+        option.textContent = getLabel(value);
+        select.appendChild(option);
+    });
+}
+
+function getSubjectFacets() {
+    return (facets[giaTypeSelect.value] || {})[subjectSelect.value] || {};
 }
 
-// Обработчик события изменения для обоих select-элементов
-function handleSelectChange(event) {
-    const selectedValue = event.target.value;
-    const otherSelectId = event.target.id === 'currentExamNumber' ? 'outdatedExamNumber' : 'currentExamNumber';
-    const otherSelect = document.getElementById(otherSelectId);
+function fillSubjectFilters() {
+    const subjectFacets = getSubjectFacets();
+    const statuses = subjectFacets.status || {};
+    const examNumbers = subjectFacets.exam_number || {};
+    const themes = subjectFacets.theme || {};
+    setOptions(statusSelect, Object.keys(STATUS_NAMES).filter(status => status in statuses),
+        status => `${STATUS_NAMES[status]} (${statuses[status]})`, true);
+    setOptions(examNumberSelect, Object.keys(examNumbers).sort((a, b) => a - b),
+        examNumber => `${examNumber} (${examNumbers[examNumber]})`, true);
+    setOptions(themeSelect,
+        Object.keys(themes).sort((a, b) => a.localeCompare(b, undefined, { numeric: true })),
+        theme => `${theme} (${themes[theme]})`, true);
+}
 
-    // Установка первого значения в другом select-элементе
-    otherSelect.value = '0';
+function fillSubjects() {
+    setOptions(subjectSelect, Object.keys(facets[giaTypeSelect.value] || {}).sort(),
+        subject => subject, false);
+    fillSubjectFilters();
+}
 
-    // Получение заданий и обновление интерфейса
-    fetchProblems(selectedValue)
-        .then(problems => {
-            const problemsDiv = document.getElementById('problems');
-            const problemsCountDiv = document.createElement('h2');
-            const type = event.target.id === 'currentExamNumber' ? 'актуальных' : 'устаревших';
-            const examNumber = Math.abs(selectedValue);
-            if (problems.length > 0) {
-                if (event.target.id === 'currentExamNumber') {
-                    problemsCountDiv.textContent = `Количество ${type} заданий ${examNumber} типа: ${problems.length}`;
-                } else {
-                    problemsCountDiv.textContent = `Количество ${type} заданий: ${problems.length}`;
-                }
-                problemsDiv.innerHTML = ''; // Очищаем содержимое элемента problems перед добавлением заданий
-                problemsDiv.appendChild(problemsCountDiv);
-                problems.forEach(problem => {
-                    const problemElement = document.createElement('div');
-                    problemElement.innerHTML = problem; // Вставляем задание как HTML
-                    problemsDiv.appendChild(problemElement);
-                });
-            } else {
-                if (event.target.id === 'currentExamNumber') {
-                    problemsCountDiv.textContent = `Нет заданий выбранного типа (${type}, ${examNumber} тип).`;
-                } else {
-                    problemsCountDiv.textContent = `Нет заданий выбранного типа (${type}).`;
-                }
-                problemsDiv.innerHTML = ''; // Очищаем содержимое элемента problems перед добавлением сообщения
-                problemsDiv.appendChild(problemsCountDiv);
+function getProblemsUrl(offset) {
+    const params = new URLSearchParams({
+        gia_type: giaTypeSelect.value,
+        subject: subjectSelect.value,
+        limit: PAGE_SIZE,
+        offset: offset,
+    });
+    [['status', statusSelect], ['exam_number', examNumberSelect], ['theme', themeSelect]]
+        .forEach(([name, select]) => {
+            if (select.value) {
+                params.set(name, select.value);
             }
-        })
-        .catch(error => {
-            console.error('Ошибка при получении заданий:', error);
         });
+    return `/problems?${params}`;
+}
+
+// Количество задач по выбранным фильтрам известно заранее, если выбрано не больше одного из них
+function getExpectedProblemsCount() {
+    const subjectFacets = getSubjectFacets();
+    const selected = [['status', statusSelect], ['exam_number', examNumberSelect], ['theme', themeSelect]]
+        .filter(([, select]) => select.value);
+    if (selected.length === 0) {
+        return Object.values(subjectFacets.status || {}).reduce((sum, count) => sum + count, 0);
+    }
+    if (selected.length === 1) {
+        const [facet, select] = selected[0];
+        return (subjectFacets[facet] || {})[select.value] || 0;
+    }
+    return null;
+}
+
+async function loadProblems(reset) {
+    const problemsDiv = document.getElementById('problems');
+    const loadMoreButton = document.getElementById('loadMore');
+    if (reset) {
+        problemsDiv.innerHTML = '';
+        loadedProblemsCount = 0;
+        const expectedProblemsCount = getExpectedProblemsCount();
+        document.getElementById('problemsCount').textContent = expectedProblemsCount === null
+            ? '' : `Количество заданий: ${expectedProblemsCount}`;
+    }
+    try {
+        const response = await fetch(getProblemsUrl(loadedProblemsCount));
+        const problems = await response.json();
+        problems.forEach(problem => {
+            const problemElement = document.createElement('div');
+            problemElement.innerHTML = problem.html; // Вставляем задание как HTML
+            problemsDiv.appendChild(problemElement);
+        });
+        loadedProblemsCount += problems.length;
+        loadMoreButton.hidden = problems.length < PAGE_SIZE;
+        if (loadedProblemsCount === 0) {
+            problemsDiv.textContent = 'Нет заданий, подходящих под выбранные фильтры.';
+        }
+    } catch (error) {
+        console.error('Ошибка при получении заданий:', error);
+    }
+}
+
+async function init() {
+    const response = await fetch('/facets');
+    facets = await response.json();
+    setOptions(giaTypeSelect, Object.keys(facets).sort(),
+        giaType => GIA_TYPE_NAMES[giaType] || giaType, false);
+    fillSubjects();
+    await loadProblems(true);
 }
 
+giaTypeSelect.addEventListener('change', () => { fillSubjects(); loadProblems(true); });
+subjectSelect.addEventListener('change', () => { fillSubjectFilters(); loadProblems(true); });
+[statusSelect, examNumberSelect, themeSelect].forEach(select => {
+    select.addEventListener('change', () => loadProblems(true));
+});
+document.getElementById('loadMore').addEventListener('click', () => loadProblems(false));
 
-// Добавление обработчика событий изменения для обоих select-элементов
-document.getElementById('currentExamNumber').addEventListener('change', handleSelectChange);
-document.getElementById('outdatedExamNumber').addEventListener('change', handleSelectChange);
+init().catch(error => console.error('Ошибка при получении фильтров:', error));